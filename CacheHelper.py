@@ -0,0 +1,153 @@
+import config
+import numpy as np
+import shapely
+import sqlite3 as sqlite
+from contextlib import contextmanager
+import threading
+import hashlib
+import logging
+import json
+import time
+import os
+
+curPath = os.path.dirname(os.path.realpath(__file__))
+
+
+def content_key(data, settings):
+    ''' Hash of the uploaded file bytes and the settings that change the output of the conversion '''
+    h = hashlib.sha256(data)
+    h.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+def file_key(filepath, settings):
+    ''' content_key of a file on disk '''
+    with open(filepath, 'rb') as f:
+        return content_key(f.read(), settings)
+
+
+class SQLiteCache():
+    '''
+    Base for the size-bounded caches kept in a SQLite database in the cache
+    directory. Every table has a size and an accessed column, when the table
+    grows over maxsize bytes the least recently used rows are evicted.
+    '''
+    table = None
+    columns = None
+
+    def __init__(self, directory, dbname, maxsize):
+        self.logger = logging.getLogger("evals logger")
+        directory = os.path.join(curPath, directory)
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+        self.dbpath = os.path.join(directory, dbname)
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        with self.transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, %s, size INTEGER, accessed REAL)' % (self.table, self.columns))
+
+    @contextmanager
+    def transaction(self):
+        conn = sqlite.connect(self.dbpath, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def evict(self, conn):
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM %s' % self.table).fetchone()[0]
+        if total <= self.maxsize:
+            return
+        for key, size in conn.execute('SELECT key, size FROM %s ORDER BY accessed' % self.table).fetchall():
+            conn.execute('DELETE FROM %s WHERE key = ?' % self.table, (key,))
+            total -= size
+            if total <= self.maxsize:
+                break
+
+
+class ResultCache(SQLiteCache):
+    '''
+    A persistent cache of finished conversions keyed by content_key. Every
+    entry holds the final GeoJSON, the per-color unions as GeoJSON text and the
+    OpStatus JSON.
+    '''
+    table = 'results'
+    columns = 'gj TEXT, unions TEXT, status TEXT'
+
+    def __init__(self, directory=None, maxsize=None):
+        SQLiteCache.__init__(self, directory if directory else config.cache['directory'], 'results.db', maxsize if maxsize else config.cache['maxsize'])
+
+    def get(self, key):
+        try:
+            with self.lock, self.transaction() as conn:
+                row = conn.execute('SELECT gj, unions, status FROM results WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    return None
+                conn.execute('UPDATE results SET accessed = ? WHERE key = ?', (time.time(), key))
+        except sqlite.Error as e:
+            self.logger.error("Error in reading from the result cache %s" % e)
+            return None
+        return {'gj': json.loads(row[0]), 'unions': json.loads(row[1]), 'status': row[2]}
+
+    def put(self, key, gj, unions, status):
+        gj = json.dumps(gj)
+        unions = json.dumps(unions)
+        size = len(gj) + len(unions) + len(status)
+        if size > self.maxsize:
+            return
+        try:
+            with self.lock, self.transaction() as conn:
+                conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)', (key, gj, unions, status, size, time.time()))
+                self.evict(conn)
+        except sqlite.Error as e:
+            self.logger.error("Error in writing to the result cache %s" % e)
+
+
+class GeometryCache(SQLiteCache):
+    '''
+    Geometries stored as WKB blobs with their bounding boxes. Writes of many
+    geometries happen in a single transaction, reads decode the blobs with
+    shapely.from_wkb in one call. The cache lives in the cache directory so
+    geometries are reused across requests.
+    '''
+    table = 'geometries'
+    columns = 'minx REAL, miny REAL, maxx REAL, maxy REAL, wkb BLOB'
+
+    def __init__(self, directory=None, maxsize=None):
+        SQLiteCache.__init__(self, directory if directory else config.cache['directory'], 'geometries.db', maxsize if maxsize else config.cache['geometrymaxsize'])
+
+    def put_many(self, geometries):
+        ''' Store a dictionary of key: geometry '''
+        if not geometries:
+            return
+        keys = list(geometries.keys())
+        geoms = np.array(list(geometries.values()), dtype=object)
+        blobs = shapely.to_wkb(geoms)
+        bounds = shapely.bounds(geoms).tolist()
+        now = time.time()
+        rows = [(key, b[0], b[1], b[2], b[3], blob, len(blob), now) for key, b, blob in zip(keys, bounds, blobs)]
+        try:
+            with self.lock, self.transaction() as conn:
+                conn.executemany('INSERT OR REPLACE INTO geometries VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                self.evict(conn)
+        except sqlite.Error as e:
+            self.logger.error("Error in writing to the geometry cache %s" % e)
+
+    def get_many(self, keys):
+        ''' Returns a dictionary of key: geometry for the keys that are in the cache '''
+        keys = list(keys)
+        if not keys:
+            return {}
+        try:
+            with self.lock, self.transaction() as conn:
+                rows = conn.execute('SELECT key, wkb FROM geometries WHERE key IN (%s)' % ','.join('?' * len(keys)), keys).fetchall()
+                conn.executemany('UPDATE geometries SET accessed = ? WHERE key = ?', [(time.time(), row[0]) for row in rows])
+        except sqlite.Error as e:
+            self.logger.error("Error in reading from the geometry cache %s" % e)
+            return {}
+        if not rows:
+            return {}
+        blobs = np.empty(len(rows), dtype=object)
+        blobs[:] = [row[1] for row in rows]
+        return dict(zip([row[0] for row in rows], shapely.from_wkb(blobs)))
@@ -0,0 +1,77 @@
+import config
+
+
+class ConversionOptions():
+    '''
+    The settings of a single conversion. Every option defaults to the value in
+    config.py, options given with an upload are validated and override them.
+
+    simplificationlevel - one of the named levels or adaptive
+    tolerance - simplification tolerance in degrees, overrides the level
+    simplificationmode - independent or topology
+    areathreshold - features smaller than this share of the largest feature are removed
+    precision - decimals of the coordinates in the GeoJSON output, also sets the grid they are snapped to
+    performancetest - run the stage 7 performance test, turn it off when only the GeoJSON is needed
+    '''
+    SIMPLIFICATIONLEVELS = ['highest', 'high', 'medium', 'low', 'default', 'none', 'adaptive']
+    SIMPLIFICATIONMODES = ['independent', 'topology']
+
+    def __init__(self, simplificationlevel=None, tolerance=None, simplificationmode=None, areathreshold=None, precision=None, performancetest=True):
+        self.simplificationlevel = simplificationlevel if simplificationlevel is not None else config.simplificationlevel
+        self.tolerance = tolerance
+        self.simplificationmode = simplificationmode if simplificationmode is not None else config.simplificationmode
+        self.areathreshold = areathreshold if areathreshold is not None else config.areathreshold
+        self.precision = precision if precision is not None else config.precision
+        self.performancetest = performancetest
+        self.validate()
+        # coordinates are snapped to the grid of the precision given with the request, the configured grid is only coarsened to the configured precision
+        gridsize = config.quantization['gridsize']
+        if gridsize and precision is not None:
+            gridsize = 10 ** -self.precision
+        elif gridsize:
+            gridsize = max(gridsize, 10 ** -self.precision)
+        self.gridsize = gridsize
+
+    def validate(self):
+        if self.simplificationlevel not in self.SIMPLIFICATIONLEVELS:
+            raise ValueError("simplificationlevel has to be one of %s" % ', '.join(self.SIMPLIFICATIONLEVELS))
+        if self.tolerance is not None and not 0 <= self.tolerance <= 1:
+            raise ValueError("tolerance has to be between 0 and 1 degrees")
+        if self.simplificationmode not in self.SIMPLIFICATIONMODES:
+            raise ValueError("simplificationmode has to be one of %s" % ', '.join(self.SIMPLIFICATIONMODES))
+        if not 0 <= self.areathreshold < 1:
+            raise ValueError("areathreshold has to be between 0 and 1")
+        if not 0 <= self.precision <= 15:
+            raise ValueError("precision has to be between 0 and 15")
+
+    @classmethod
+    def from_dict(cls, options):
+        ''' Options from the fields of an upload form, all the values can be strings '''
+        options = dict(options)
+        unknown = set(options) - set(['simplificationlevel', 'tolerance', 'simplificationmode', 'areathreshold', 'precision', 'performancetest'])
+        if unknown:
+            raise ValueError("Unknown options: %s" % ', '.join(sorted(unknown)))
+        try:
+            for key, parse in [('tolerance', float), ('areathreshold', float), ('precision', int)]:
+                if options.get(key) not in [None, '']:
+                    options[key] = parse(options[key])
+                else:
+                    options.pop(key, None)
+        except (TypeError, ValueError):
+            raise ValueError("%s has to be a number" % key)
+        performancetest = options.get('performancetest', True)
+        if not isinstance(performancetest, bool):
+            if str(performancetest).lower() not in ['true', 'false', '1', '0']:
+                raise ValueError("performancetest has to be true or false")
+            options['performancetest'] = str(performancetest).lower() in ['true', '1']
+        return cls(**options)
+
+    def cache_settings(self):
+        ''' The options that change the output of a conversion '''
+        settings = {'simplificationlevel': self.simplificationlevel, 'tolerance': self.tolerance, 'simplificationmode': self.simplificationmode,
+                    'areathreshold': self.areathreshold, 'precision': self.precision, 'gridsize': self.gridsize, 'performancetest': self.performancetest}
+        if self.simplificationlevel == 'adaptive' and self.tolerance is None:
+            settings['adaptivesimplification'] = config.adaptivesimplification
+            if config.adaptivesimplification['p95test']:
+                settings['performance'] = {k: config.performance[k] for k in ['p95seconds', 'diagramsize']}
+        return settings
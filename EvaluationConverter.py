@@ -2,20 +2,24 @@ import config
 import ShapelyHelper, EvaluationFileOps
 from shapely.ops import unary_union
 from shapely.geometry.base import BaseGeometry
-from shapely.geometry import shape, mapping, shape, asShape
+from shapely.geometry import shape, mapping, shape
 from shapely.geometry import MultiPolygon, MultiPoint, MultiLineString
 from shapely.validation import explain_validity
-from shapely import speedups
-if speedups.available:
-        speedups.enable()   
 import sqlite3 as sqlite
 import fiona 
 import time
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from fiona.crs import to_string
 import  json, geojson
-from sqlitedict import SqliteDict
+import CacheHelper
+import shapely
+import numpy as np
+from ConversionOptions import ConversionOptions
 import os, sys
+import io
+import tracemalloc
+from contextlib import contextmanager
 from os import listdir
 from os.path import isfile, join
 import os.path as osp
@@ -49,12 +53,21 @@ def configure_logging(name):
 
 curPath = os.path.dirname(os.path.realpath(__file__))
 
+# Change this when the output of the conversion changes, cached results of older versions are not reused
+PIPELINE_VERSION = 5
+
+def cache_settings(options=None):
+    ''' The settings that change the output of a conversion, part of every cache key '''
+    settings = (options if options else ConversionOptions()).cache_settings()
+    settings['version'] = PIPELINE_VERSION
+    return settings
+
 class OpStatus():
     
     def __init__(self):
         self.stages = {}
         for i in range(1,8):
-            x = {'status':3, 'errors':[],'warnings':[], 'info':[], 'debug':[], 'success':[], 'statustext':""}
+            x = {'status':3, 'errors':[],'warnings':[], 'info':[], 'debug':[], 'success':[], 'statustext':"", 'timings':{}, 'profile':{}, 'workload':{}}
             self.stages[i] = x
         self.current_milli_time = lambda: int(round(time.time() * 1000))
     
@@ -73,6 +86,46 @@ class OpStatus():
     def add_debug(self, stage, msg):
         self.stages[stage]['debug'].append({'msg':msg,'time':self.current_milli_time()})
 
+    def add_timing(self, stage, name, seconds):
+        self.stages[stage]['timings'][name] = round(seconds, 4)
+        self.add_info(stage, "%s took %.4f seconds" % (name, seconds))
+
+    def add_workload(self, stage, name, summary):
+        ''' Latency percentiles and throughput of the simulated diagrams of a color '''
+        self.stages[stage]['workload'][name] = summary
+        if summary['diagrams']:
+            self.add_info(stage, "%s: %s diagrams, p50 %.4f p95 %.4f p99 %.4f seconds, %s diagrams per second" % (name, summary['diagrams'], summary['p50'], summary['p95'], summary['p99'], summary['diagramspersecond']))
+
+    @contextmanager
+    def measure(self, stage):
+        ''' Adds the wall and CPU seconds of the block to the profile of a stage,
+        a stage can be measured in several blocks. The block fills in the
+        feature and vertex counts of the record it is given. The CPU seconds
+        are of the whole process, GEOS threads included. '''
+        record = {'featuresin': 0, 'featuresout': 0, 'verticesin': 0, 'verticesout': 0}
+        if tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        wallstart, cpustart = time.time(), time.process_time()
+        try:
+            yield record
+        finally:
+            self.add_profile(stage, wallstart, time.time() - wallstart, time.process_time() - cpustart, record)
+
+    def add_profile(self, stage, wallstart, wallseconds, cpuseconds, record):
+        profile = self.stages[stage]['profile']
+        profile['started'] = min(profile.get('started', int(wallstart * 1000)), int(wallstart * 1000))
+        profile['finished'] = self.current_milli_time()
+        profile['wallseconds'] = round(profile.get('wallseconds', 0) + wallseconds, 4)
+        profile['cpuseconds'] = round(profile.get('cpuseconds', 0) + cpuseconds, 4)
+        for name, count in record.items():
+            profile[name] = profile.get(name, 0) + int(count)
+        if profile['wallseconds']:
+            profile['featurespersecond'] = round(profile['featuresin'] / profile['wallseconds'], 1)
+            profile['verticespersecond'] = round(profile['verticesin'] / profile['wallseconds'], 1)
+        profile['peakmemory'] = ShapelyHelper.peak_memory()
+        if tracemalloc.is_tracing():
+            profile['tracedpeakmemory'] = max(profile.get('tracedpeakmemory', 0), round(tracemalloc.get_traced_memory()[1] / 1048576.0, 2))
+
     def set_statustext(self, stage, msg):
         self.stages[stage]['statustext'] = msg
 
@@ -81,6 +134,33 @@ class OpStatus():
         if statustext:
             self.stages[stage]['statustext']= statustext
 
+    def merge(self, other, prefix):
+        ''' Adds the messages and timings of another OpStatus prefixed with its
+        name, the status of a stage becomes the worse of the two '''
+        # errors, then warnings, information, success and not started
+        severity = [0, 2, 4, 1, 3]
+        for stage, results in other.stages.items():
+            for kind in ['errors', 'warnings', 'info', 'debug', 'success']:
+                self.stages[stage][kind].extend({'msg': "%s: %s" % (prefix, m['msg']), 'time': m['time']} for m in results[kind])
+            for name, seconds in results['timings'].items():
+                self.stages[stage]['timings']["%s %s" % (prefix, name)] = seconds
+            if results['profile']:
+                # the layers run at the same time, the stage takes from the first start to the last finish
+                profile = self.stages[stage]['profile']
+                profile.setdefault('layers', {})[prefix] = results['profile']
+                profile['started'] = min(profile.get('started', results['profile']['started']), results['profile']['started'])
+                profile['finished'] = max(profile.get('finished', 0), results['profile']['finished'])
+                profile['wallseconds'] = round((profile['finished'] - profile['started']) / 1000.0, 4)
+                for name in ['featuresin', 'featuresout', 'verticesin', 'verticesout']:
+                    profile[name] = profile.get(name, 0) + results['profile'][name]
+                if profile['wallseconds']:
+                    profile['featurespersecond'] = round(profile['featuresin'] / profile['wallseconds'], 1)
+                    profile['verticespersecond'] = round(profile['verticesin'] / profile['wallseconds'], 1)
+                profile['peakmemory'] = max(profile.get('peakmemory') or 0, results['profile'].get('peakmemory') or 0)
+            if severity.index(results['status']) < severity.index(self.stages[stage]['status']):
+                self.stages[stage]['status'] = results['status']
+                self.stages[stage]['statustext'] = results['statustext'] if results['status'] == 1 else "%s: %s" % (prefix, results['statustext'])
+
     def get_all_status(self):
         allstatus = {}
         for stage, results in self.stages.items():
@@ -113,13 +193,20 @@ class ConvertEvaluation():
     4 - Information
 
     '''
-    def __init__(self):
-        self.SOURCE_FILE_SHARE = os.path.join(curPath, config.inputs['directory'])
-        self.WORKING_SHARE = os.path.join(curPath, config.working['directory'])
+    def __init__(self, workspace=None, opstatus=None, options=None):
+        # every conversion has its own input, working and output directories
+        self.workspace = workspace if workspace else EvaluationFileOps.Workspace()
+        self.SOURCE_FILE_SHARE = self.workspace.SOURCE_FILE_SHARE
+        self.WORKING_SHARE = self.workspace.WORKING_SHARE
         # final GEOJSON
-        self.OUTPUT_SHARE = os.path.join(curPath, config.geojsonoutput['directory'])
+        self.OUTPUT_SHARE = self.workspace.OUTPUT_SHARE
         self.logger = configure_logging('evals logger')
-        self.opstatus = OpStatus()
+        self.opstatus = opstatus if opstatus else OpStatus()
+        self.options = options if options else ConversionOptions()
+        if config.profiling['tracemalloc'] and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        # per-color union feature collections of the performance check
+        self.unions = {}
         
     def convert(self):
         def isSQLite(filename):
@@ -155,7 +242,6 @@ class ConvertEvaluation():
             return True 
 
         self.logger.info("Geodesignhub Evaluations Converter")    
-        myShpFileHelper = EvaluationFileOps.GeopackageHelper(self.opstatus)
         self.logger.info("Reading source files.. ")
         curPath = os.path.dirname(os.path.realpath(__file__))
         allBounds = []
@@ -192,8 +278,8 @@ class ConvertEvaluation():
             self.opstatus.set_status(stage=1, status=1, statustext ="gpkg file read without problems")
             self.opstatus.add_success(stage=1, msg = "File contents read successfully")
             
-        myFileOps = EvaluationFileOps.FileOperations(self.SOURCE_FILE_SHARE, self.OUTPUT_SHARE, self.WORKING_SHARE,self.opstatus)
         allGJ = {}
+        allFeatures = {}
         geometrysuccess= 0
         reprojectstatus = 0
         if (ferror == False) and gpkgfiles and len(gpkgfiles)==1:
@@ -202,197 +288,161 @@ class ConvertEvaluation():
             for f in gpkgfiles:
                 filepath = os.path.join(self.SOURCE_FILE_SHARE, f)
 
-                # validate features and schema
-                with fiona.open(filepath, driver='GPKG') as curfile:
-
-                    schema = curfile.schema
-                    schemavalidates = myShpFileHelper.validateSchema(schema)    
-                    featuresvalidate = myShpFileHelper.validateFeatures(curfile)
-
-                try: 
-                    assert schemavalidates
-                    self.logger.info("Every feature is a polygon")
-                    self.opstatus.add_info(stage=3, msg = "Every feature is a polygon")
-                except AssertionError as e:
-                    self.logger.error("Your file has features that are not 'Polygons', please ensure that all 3D Polygons etc. are removed.")
-                    self.opstatus.add_error(stage=3, msg = "Input Geopackage does not have the correct geometry. Your file has features that are not 'Polygons', please ensure that all 3D Polygons etc. are removed.")
-                    
-                try: 
-                    assert featuresvalidate
-                    self.logger.info("Every feature as the correct areatype")
-                    self.opstatus.add_info(stage=3, msg = "Every feature has the correct areatype value one of: red, yellow, green, green2, green3")
-                except AssertionError as e: 
-                    self.logger.error("Features in a Geopackage must have allowed areatype attributes")
-                    self.opstatus.add_error(stage=3, msg = "Features in a Geopackage must have allowed areatype attributes")
-                    
-                
-                
-                if schemavalidates and featuresvalidate:
-                        self.opstatus.set_status(stage=3, status=1, statustext ="Geopackage has the areatype column and correct values in the attribtute table.")
-                        self.opstatus.add_success(stage=3, msg = "Geopackage has the areatype column and correct values in the attribtute table")
+                layers = fiona.listlayers(filepath)
+                if len(layers) > 1:
+                    self.opstatus.add_info(stage=2, msg = "Found %s layers: %s" % (len(layers), ', '.join(layers)))
+                    # every layer goes through the pipeline on its own thread with its own status, the statuses are merged when it finishes
+                    layerstatuses = [OpStatus() for layer in layers]
+                    with ThreadPoolExecutor(max_workers=config.performance['workers']) as executor:
+                        layerresults = list(executor.map(lambda layer, layerstatus: self.convert_layer(filepath, layer, layerstatus, multilayer=True), layers, layerstatuses))
+                    for layer, layerstatus in zip(layers, layerstatuses):
+                        self.opstatus.merge(layerstatus, prefix=layer)
                 else:
-                    self.opstatus.set_status(stage=3, status=0, statustext ="A areatype attribute is either not present or have the correct value or the features are not 'Polygon' geometry. For further information please refer: <a href='https://community.geodesignhub.com/t/geojson-shapefile-feature-attributes/55' target='_blank'>GeoJSON / Geopackage feature attributes</a>")
-                    if not featuresvalidate:
-                        self.opstatus.add_error(stage=3, msg = "Your Geopackage attribute table must have a areatype column with the correct attribute and all features should be 'Polygon' geometry.")
-                    if not schemavalidates:                        
-                        self.opstatus.add_error(stage=3, msg = "Your Geopackage does not have the correct values for the areatype column, it has to be one of  red, yellow, green, green2, green3")
-
-                # Reproject the file. 
-                if schemavalidates and featuresvalidate:
-                    spfile = myFileOps.multipart_to_singlepart(filepath)
-                    reprojectedfile, hasReprojErrors = myFileOps.reprojectFile(spfile)
-
-                    if hasReprojErrors:
-                        self.opstatus.set_status(stage=4, status=4, statustext ="There were errors in reprojecting some features, they are removed from output.")
-                    else: 
-                        self.opstatus.set_status(stage=4, status=1, statustext ="Geopackage reprojected successfully")
-
-                    self.opstatus.add_success(stage=4, msg = "Reprojected file successfully written successfully")
-
-                    simplifiedfile, bounds = myFileOps.simplifyReprojectedFile(reprojectedfile)
-                    
-                    allBounds.append(bounds)
-                    try:
-
-                        gjFile = myShpFileHelper.convert_gpkg_to_geojson(simplifiedfile, self.WORKING_SHARE) 
-                    except Exception as e: 
-                        self.logger.error("Error in converting Geopackage to Geojson %s" %e)
-                        self.opstatus.set_status(stage=6, status=0, statustext ="Error in converting Geopackage to GeoJSON")
-                        self.opstatus.add_error(stage=6, msg = "Error in converting Geopackage to GeoJSON %s" %e)
-
-                    with open(gjFile,'r') as gj:
-                        allGJ[f] = json.loads(gj.read())
-
-                else: 
-                    self.opstatus.set_status(stage=4, status=0, statustext ="There are errors in file attribute table, reprojection not started")
-                    self.opstatus.add_error(stage=4, msg = "Check the attribute table for areatype column and correct areatype value.")
-                    self.opstatus.set_status(stage=5, status=0, statustext ="File attribute table does not validate, therefore will not simplify")
-                    self.opstatus.add_error(stage=5, msg = "Check the attribute table for areatype column and correct areatype value")
-                    self.opstatus.set_status(stage=6, status=0, statustext ="Geopackage not converted to GeoJSON. ")
-                    self.opstatus.add_error(stage=6, msg = "File will not be converted to GeoJSON, see earlier errors")
-                    self.opstatus.set_status(stage=7, status=0, statustext ="Performance testing not started, please upload the correct file")
-                    self.opstatus.add_error(stage=7, msg = "File performance will not be checked, please review earlier errors")
+                    layerresults = [self.convert_layer(filepath, layers[0], self.opstatus)]
+
+                allGJ[f] = {}
+                for layer, layerresult in zip(layers, layerresults):
+                    if layerresult is not None:
+                        features, gjFile, bounds = layerresult
+                        allBounds.append(bounds)
+                        allFeatures[(f, layer)] = features
+                        # the GeoJSON text is kept as written so it can be streamed without encoding it again
+                        with open(gjFile, 'r') as gj:
+                            allGJ[f][layer] = gj.read()
 
             # TODO: make this multifile
             try:
-                assert 0 in set(self.opstatus.get_all_status().values())
-                self.opstatus.set_status(stage=7, status=0, statustext= "There were errors in pervious stages, performance testing will not be conducted until they are resolved. ")
+                assert 0 in set(self.opstatus.get_all_status().values()) or not self.options.performancetest
+                if 0 in set(self.opstatus.get_all_status().values()):
+                    self.opstatus.set_status(stage=7, status=0, statustext= "There were errors in pervious stages, performance testing will not be conducted until they are resolved. ")
+                else:
+                    self.opstatus.set_status(stage=7, status=4, statustext= "Performance testing was not requested for this conversion.")
             except AssertionError as ea:                  
                 self.logger.info("Starting perfomrance analysis")
+                performancestart, performancecpustart = time.time(), time.process_time()
+                # evaluation features and vertices in, union polygons and vertices out
+                performanceprofile = {'featuresin': 0, 'featuresout': 0, 'verticesin': 0, 'verticesout': 0}
                 myGeomOps = ShapelyHelper.GeomOperations()
                 allBounds = myGeomOps.calculateBounds(allBounds)
                 allBounds = allBounds.split(',')
                 allBounds = [float(i) for i in allBounds]
 
                 evalulationColors = ['red2','red', 'yellow', 'green', 'green2','green3']
-                evalPaths = [f for f in listdir(self.WORKING_SHARE) if (isfile(join(self.WORKING_SHARE, f)) and (os.path.splitext(f)[1] == '.geojson'))]
-                # generate random features
-
-                featData = {"type":"FeatureCollection", "features":[]}
-                myGJHelper = ShapelyHelper.GeoJSONHelper()
-                
-                self.logger.info("Generating random features within the bounds")
-                self.opstatus.add_info(stage=7, msg = "Generating random features within the evaluation feature bounds")
-                for i in range(5):
-                    x = myGJHelper.genRandom(featureType="Polygon", numberVertices=4, boundingBox= allBounds)
-                    f = {"type": "Feature", "properties": {},"geometry": json.loads(geojson.dumps(x))}
-                    featData['features'].append(f)
-
-                # polygonize the features
-                combinedPlanPolygons = []
-                for feature in featData['features']:
-                    combinedPlanPolygons.append(asShape(feature['geometry']))
-                allPlanPolygons = MultiPolygon([x for x in combinedPlanPolygons if x.geom_type == 'Polygon' and x.is_valid])
-                allPlanPolygons = unary_union(allPlanPolygons)
+                # generate the diagrams the server intersects with the evaluation
+                self.logger.info("Generating diagrams within the bounds")
+                simulator = ShapelyHelper.WorkloadSimulator(allBounds)
+                self.opstatus.add_info(stage=7, msg = "Generated %s diagrams within the evaluation feature bounds" % len(simulator.diagrams))
                 # read the evaluations
-                timetaken = []
-                for fname in evalPaths:
-                    self.logger.debug("Currently processsing: %s" % fname)
-                    self.opstatus.add_info(stage=7, msg = "Currently processsing: %s" % fname)
-
-                    evalFPath = os.path.join(self.WORKING_SHARE, fname)
-                    cacheKey = os.path.basename(evalFPath)
-                    
-                    filepath = os.path.join(self.WORKING_SHARE, 'some.db')
-                    s = SqliteDict(filepath, autocommit=False)
-                    # read the evaluation file
-                    with open(evalFPath, 'r') as gjFile:
-                            data = gjFile.read()
-                            evalData = json.loads(data)
-
-                    colorDict =  {'red':[],'red2':[], 'yellow':[],'green':[],'green2':[], 'green3':[],'constraints':[]}
-                    errorDict =  {'red':0,'red2':0, 'yellow':0,'green':0,'green2':0,'green3':0, 'constraints':0}
-
-                    for curFeature in evalData['features']:
-                        areatype = curFeature['properties']['areatype']
-                        errorCounter = errorDict[areatype]
-                        shp, errorCounter = myGeomOps.genFeature(curFeature['geometry'], errorCounter)
-                        errorDict[areatype] = errorCounter
-                        if shp:
-                            colorDict[areatype].append(shp) 
+                successes = []
+                slowest = None
+                geomcache = CacheHelper.GeometryCache()
+                for (fname, layer), evalFeatures in allFeatures.items():
+                    self.logger.debug("Currently processsing: %s %s" % (fname, layer))
+                    self.opstatus.add_info(stage=7, msg = "Currently processsing: %s layer %s" % (fname, layer))
+                    # the union and intersection files of a layer are prefixed with its name when there are several
+                    layerprefix = layer + '-' if len(allGJ[fname]) > 1 else ''
+                    self.unions[layer] = {}
+
+                    cacheKey = CacheHelper.file_key(os.path.join(self.SOURCE_FILE_SHARE, fname), dict(cache_settings(self.options), layer=layer))
+
+                    colorDict = {areatype: evalFeatures.areatype_geoms(areatype) for areatype in ['red','red2', 'yellow','green','green2', 'green3','constraints']}
                         
-                    self.logger.info("Geometry errors in %(A)s Red2, %(B)s Red, %(C)s Yellow, %(D)s Green, %(E)s Green2, %(F)s Green3 and %(G)s Constraints features." % {'A' : errorDict['red2'], 'B' : errorDict['red'], 'C':errorDict['yellow'], 'D':errorDict['green'], 'E':errorDict['green2'],'F':errorDict['green3'], 'G': errorDict['constraints']})
-
-                    self.opstatus.add_info(stage=7, msg = "Geometry errors in %(A)s Red2, %(B)s Red, %(C)s Yellow, %(D)s Green, %(E)s Green2, %(F)s Green3 and %(G)s Constraints features." % {'A' : errorDict['red2'], 'B' : errorDict['red'], 'C':errorDict['yellow'], 'D':errorDict['green'], 'E':errorDict['green2'],'F':errorDict['green3'], 'G': errorDict['constraints']})
-                
                     # self.logger.debug(len(colorDict['red2']), len(colorDict['red']), len(colorDict['yellow']), len(colorDict['green']),len(colorDict['green2']),len(colorDict['green3']),len(colorDict['constraints']))
                     x = "Processed " + str(len(colorDict['red2'])) + " Red2, "+  str(len(colorDict['red']))+ " Red, "+ str(len(colorDict['yellow']))+ " Yellow, "+ str(len(colorDict['green']))+ " Yellow, "+str(len(colorDict['green2']))+ " Yellow, "+str(len(colorDict['green3']))+ " Green3 features."
                     
                     self.opstatus.add_info(stage=7, msg = x)
 
-                    import time
+                    def timedUnion(k):
+                        colorstart = time.time()
+                        u = myGeomOps.genUnaryUnion(colorList=colorDict[k], progress=lambda msg: self.opstatus.add_debug(stage=7, msg = "%s: %s" % (k, msg)), coverage=evalFeatures.coverage)
+                        # the union keeps the output grid of the snapped features, the diagrams are intersected at floating precision like the unions read back from WKB
+                        return k, shapely.set_precision(u, 0), time.time() - colorstart
+
                     start_time = time.time()
 
-                    # create a union and write to SqliteDict this is to test caching performance.   
+                    # unions of the same layer and settings from an earlier conversion are read from the geometry cache, the other colors are unioned
+                    cachedUnions = geomcache.get_many([cacheKey + '-' + k for k in colorDict.keys()])
                     for k in colorDict.keys():
-                        u = myGeomOps.genUnaryUnion(colorList=colorDict[k])
-                        curCacheKey = cacheKey + '-' + k
-                        if curCacheKey not in s.keys() and u:
-                            s[curCacheKey] = u
-                    s.commit()
+                        if cacheKey + '-' + k in cachedUnions:
+                            self.opstatus.add_info(stage=7, msg = "%s%s union read from the geometry cache" % (layerprefix, k))
+
+                    # create the color unions in parallel, GEOS releases the GIL so they run on all cores
+                    with ThreadPoolExecutor(max_workers=config.performance['workers']) as executor:
+                        colorUnions = list(executor.map(timedUnion, [k for k in colorDict.keys() if cacheKey + '-' + k not in cachedUnions]))
+
+                    # the unions computed here are used as they are, the cache is only written to so later conversions can reuse them
+                    layerUnions = {k: cachedUnions[cacheKey + '-' + k] for k in colorDict.keys() if cacheKey + '-' + k in cachedUnions}
+                    newUnions = {}
+                    for k, u, colortime in colorUnions:
+                        self.opstatus.add_timing(stage=7, name="%s%s union" % (layerprefix, k), seconds=colortime)
+                        layerUnions[k] = u
+                        if u:
+                            newUnions[cacheKey + '-' + k] = u
+                    geomcache.put_many(newUnions)
                     self.logger.debug("--- %.4f seconds ---" % float(time.time() - start_time))
-                    timetaken.append(float(time.time() - start_time))
-                    self.opstatus.set_statustext(stage=7, msg = "Processing took %.4f seconds " % float(time.time() - start_time))
                     # -- write to union json file
                     for k in colorDict.keys():
-                        curCacheKey = cacheKey+ '-' + k
-                        try:
-                            u = s[curCacheKey]
-                        except KeyError as e: 
-                            u = []
+                        u = layerUnions.get(k)
                         if u:
-                            featureCollectionList = []
-                            allJSON = ShapelyHelper.export_to_JSON(u)
-                            featureCollectionList.append(myGeomOps.constructSingleFeatureDef(allJSON,k))
-                            outputJSON = {}
-                            outputJSON["type"] = "FeatureCollection"
-                            outputJSON["features"]= featureCollectionList
-                            fname = k + '.json'
-                            uf = os.path.join(self.OUTPUT_SHARE, fname)
+                            uf = os.path.join(self.OUTPUT_SHARE, layerprefix + k + '.json')
+                            unionJSON = io.StringIO()
+                            myGeoJSONWriter = ShapelyHelper.GeoJSONWriter(unionJSON, precision=self.options.precision)
+                            myGeoJSONWriter.write_featurecollection([({'areatype':k}, u)])
+                            self.unions[layer][k] = unionJSON.getvalue()
                             with open(uf, 'w') as outFile:
-                                json.dump(outputJSON , outFile)
-                    # -- write to intersection json file
+                                outFile.write(self.unions[layer][k])
+                    # -- cut, index and prepare the polygons of every color union once for all the diagrams, the indexes are kept in memory
+                    engines = {}
                     for k in colorDict.keys():
-                        curCacheKey = cacheKey+ '-' + k
+                        u = layerUnions.get(k)
+                        if u and not u.is_empty:
+                            indexstart = time.time()
+                            engines[k] = ShapelyHelper.IntersectionEngine(u)
+                            self.opstatus.add_timing(stage=7, name="%s%s index" % (layerprefix, k), seconds=time.time() - indexstart)
+                    # -- write to intersection json file
+                    def timedIntersection(k, evalFeats):
                         self.logger.debug("%s intersection starts" % k)
-                        # self.opstatus.add_debug(stage=7, msg = "%s intersection starts" % k)
-                        fname = k + '-intersect.json'
-                        o = os.path.join(self.OUTPUT_SHARE, fname)
-                        try:
-                            evalFeats = s[curCacheKey]
-                        except KeyError as e: 
-                            evalFeats = []
-                        if evalFeats:
-                            with open(o, 'w') as outFile:
-                                op, geometrysuccess = myGeomOps.checkIntersection(allPlanPolygons,evalFeats, k)
-                                json.dump( op, outFile)
+                        if not evalFeats:
+                            return k, None, None, None, 0
+                        intersections, areas, latencies, success = simulator.run(myGeomOps, evalFeats, k, engine=engines.get(k))
+                        return k, intersections, areas, latencies, success
+
+                    colorFeats = [layerUnions.get(k) for k in colorDict.keys()]
+                    unionParts = shapely.get_parts(np.array([u for u in colorFeats if u is not None], dtype=object))
+                    performanceprofile['featuresin'] += len(evalFeatures)
+                    performanceprofile['verticesin'] += shapely.get_num_coordinates(evalFeatures.geoms).sum()
+                    performanceprofile['featuresout'] += len(unionParts)
+                    performanceprofile['verticesout'] += shapely.get_num_coordinates(unionParts).sum()
+                    with ThreadPoolExecutor(max_workers=config.performance['workers']) as executor:
+                        colorIntersections = list(executor.map(timedIntersection, colorDict.keys(), colorFeats))
+                    for engine in engines.values():
+                        engine.close()
+
+                    for k, intersections, areas, latencies, success in colorIntersections:
+                        if intersections is not None:
+                            successes.append(success)
+                            workload = simulator.summarize(latencies)
+                            if k in engines:
+                                # union polygons skipped, containing a diagram, inside a diagram and intersected exactly
+                                workload.update(engines[k].stats)
+                            self.opstatus.add_workload(stage=7, name="%s%s" % (layerprefix, k), summary=workload)
+                            if slowest is None or workload['p95'] > slowest[1]['p95']:
+                                slowest = ("%s%s" % (layerprefix, k), workload)
+                            o = os.path.join(self.OUTPUT_SHARE, layerprefix + k + '-intersect.json')
+                            with open(o, 'w', buffering=1024 * 1024) as outFile:
+                                myGeoJSONWriter = ShapelyHelper.GeoJSONWriter(outFile, precision=self.options.precision)
+                                myGeoJSONWriter.write_featurecollection(({'areatype':k, 'diagram':i, 'area':area}, x) for i, (x, area) in enumerate(zip(intersections, areas)) if x is not None and not x.is_empty)
                     
                         else: 
                             self.logger.info("No %s features in input evaluation." % k)
-                            self.opstatus.add_info(stage=7, msg = "No %s features in evaluation file." % k)
+                            self.opstatus.add_info(stage=7, msg = "No %s features in %s layer." % (k, layer))
                 
-                if max(timetaken) > 4.0:
-                    self.opstatus.set_status(stage=7, status=0, statustext= "Your file is either too large or is taking too much time to process, it is recommended that you reduce the features or simplify them.")
+                self.opstatus.add_profile(7, performancestart, time.time() - performancestart, time.process_time() - performancecpustart, performanceprofile)
+                if slowest is not None:
+                    self.opstatus.set_statustext(stage=7, msg = "95%% of the diagrams intersected with %s within %.4f seconds, %s diagrams per second" % (slowest[0], slowest[1]['p95'], slowest[1]['diagramspersecond']))
+                geometrysuccess = int(bool(successes) and all(successes))
+                if slowest is not None and slowest[1]['p95'] > config.performance['p95seconds']:
+                    self.opstatus.set_status(stage=7, status=0, statustext= "Intersecting a diagram with the %s features takes more than %.4f seconds for 5%% of the diagrams, it is recommended that you reduce the features or simplify them." % (slowest[0], slowest[1]['p95']))
                 elif geometrysuccess ==0: 
                     self.opstatus.set_status(stage=7, status=0, statustext= "Your file has topology and geometry errors. Please fix them and try again. ")
                 else:
@@ -404,15 +454,79 @@ class ConvertEvaluation():
 
         return allGJ , self.opstatus.get_allstatuses()
 
-    def cleanDirectories(self):
-        dirs = [self.WORKING_SHARE, self.SOURCE_FILE_SHARE, self.OUTPUT_SHARE]
-        for folder in dirs:
-            for the_file in os.listdir(folder):
-                file_path = os.path.join(folder, the_file)
+    def convert_layer(self, filepath, layer, opstatus, multilayer=False):
+        ''' Runs stages 3 to 6 on a layer of a Geopackage and updates opstatus,
+        returns the converted FeatureBatch, the GeoJSON file and the bounds or
+        None if the layer does not convert '''
+        myShpFileHelper = EvaluationFileOps.GeopackageHelper(opstatus)
+        myFileOps = EvaluationFileOps.FileOperations(self.SOURCE_FILE_SHARE, self.OUTPUT_SHARE, self.WORKING_SHARE, opstatus, debug=config.debug, options=self.options)
+        # validate the schema and stream the features through the pipeline once
+        features, gjFile, bounds, hasReprojErrors = None, None, None, False
+        with fiona.open(filepath, driver='GPKG', layer=layer) as curfile:
+
+            schema = curfile.schema
+            schemavalidates = myShpFileHelper.validateSchema(schema)    
+            if schemavalidates:
                 try:
-                    if (os.path.isfile(file_path) and (the_file != 'README')):
-                        os.unlink(file_path)
-                    elif os.path.isdir(file_path): shutil.rmtree(file_path)
-                except Exception as e:
-                    
-                    self.logger.error("Error Clearing out share. %s " % e)
\ No newline at end of file
+                    features, gjFile, bounds, hasReprojErrors = myFileOps.convert_file(curfile, filepath, layer=layer if multilayer else None)
+                except Exception as e: 
+                    self.logger.error("Error in converting Geopackage to Geojson %s" %e)
+                    opstatus.set_status(stage=6, status=0, statustext ="Error in converting Geopackage to GeoJSON")
+                    opstatus.add_error(stage=6, msg = "Error in converting Geopackage to GeoJSON %s" %e)
+            featuresvalidate = myFileOps.featuresvalidate
+
+        try: 
+            assert schemavalidates
+            self.logger.info("Every feature is a polygon")
+            opstatus.add_info(stage=3, msg = "Every feature is a polygon")
+        except AssertionError as e:
+            self.logger.error("Your file has features that are not 'Polygons', please ensure that all 3D Polygons etc. are removed.")
+            opstatus.add_error(stage=3, msg = "Input Geopackage does not have the correct geometry. Your file has features that are not 'Polygons', please ensure that all 3D Polygons etc. are removed.")
+            
+        try: 
+            assert featuresvalidate
+            self.logger.info("Every feature as the correct areatype")
+            opstatus.add_info(stage=3, msg = "Every feature has the correct areatype value one of: red, yellow, green, green2, green3")
+        except AssertionError as e: 
+            self.logger.error("Features in a Geopackage must have allowed areatype attributes")
+            opstatus.add_error(stage=3, msg = "Features in a Geopackage must have allowed areatype attributes")
+            
+        
+        
+        if schemavalidates and featuresvalidate:
+                opstatus.set_status(stage=3, status=1, statustext ="Geopackage has the areatype column and correct values in the attribtute table.")
+                opstatus.add_success(stage=3, msg = "Geopackage has the areatype column and correct values in the attribtute table")
+        else:
+            opstatus.set_status(stage=3, status=0, statustext ="A areatype attribute is either not present or have the correct value or the features are not 'Polygon' geometry. For further information please refer: <a href='https://community.geodesignhub.com/t/geojson-shapefile-feature-attributes/55' target='_blank'>GeoJSON / Geopackage feature attributes</a>")
+            if not featuresvalidate:
+                opstatus.add_error(stage=3, msg = "Your Geopackage attribute table must have a areatype column with the correct attribute and all features should be 'Polygon' geometry.")
+            if not schemavalidates:                        
+                opstatus.add_error(stage=3, msg = "Your Geopackage does not have the correct values for the areatype column, it has to be one of  red, yellow, green, green2, green3")
+
+        if schemavalidates and featuresvalidate:
+            if hasReprojErrors:
+                opstatus.set_status(stage=4, status=4, statustext ="There were errors in reprojecting some features, they are removed from output.")
+            else: 
+                opstatus.set_status(stage=4, status=1, statustext ="Geopackage reprojected successfully")
+
+            opstatus.add_success(stage=4, msg = "Features reprojected successfully")
+
+            if features is not None:
+                return features, gjFile, bounds
+
+        else: 
+            opstatus.set_status(stage=4, status=0, statustext ="There are errors in file attribute table, reprojection not started")
+            opstatus.add_error(stage=4, msg = "Check the attribute table for areatype column and correct areatype value.")
+            opstatus.set_status(stage=5, status=0, statustext ="File attribute table does not validate, therefore will not simplify")
+            opstatus.add_error(stage=5, msg = "Check the attribute table for areatype column and correct areatype value")
+            opstatus.set_status(stage=6, status=0, statustext ="Geopackage not converted to GeoJSON. ")
+            opstatus.add_error(stage=6, msg = "File will not be converted to GeoJSON, see earlier errors")
+            opstatus.set_status(stage=7, status=0, statustext ="Performance testing not started, please upload the correct file")
+            opstatus.add_error(stage=7, msg = "File performance will not be checked, please review earlier errors")
+        return None
+
+    def cleanDirectories(self):
+        try:
+            self.workspace.cleanup()
+        except Exception as e:
+            self.logger.error("Error Clearing out share. %s " % e)
@@ -1,29 +1,239 @@
-from shapely.geometry import shape, mapping, shape, asShape
+from shapely.geometry import shape, mapping, shape
 from shapely.geometry.base import BaseGeometry
+import shapely
 from shapely.geometry import MultiPolygon, MultiPoint, MultiLineString
 import os, sys
+import shutil
+import tempfile
 import json
+import sqlite3 as sqlite
 import fiona 
-from pyproj import Proj, transform
+from pyproj import CRS, Transformer
+import numpy as np
 from fiona.crs import from_epsg
 import config
+from ConversionOptions import ConversionOptions
 
 import logging
 import ShapelyHelper
 from fiona import collection
 import functools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice
 try:
     from itertools import imap
 except ImportError:
     # Python 3...
     imap=map
-# import numpy as np
+
+# One Transformer per source CRS, shared by every conversion in the process
+_transformers = {}
+
+def get_transformer(crs):
+	''' Returns the cached Transformer from crs to EPSG:4326 or None if crs is already EPSG:4326 '''
+	srs = CRS.from_user_input(crs)
+	key = srs.to_wkt()
+	if key not in _transformers:
+		if srs.equals(CRS.from_epsg(4326), ignore_axis_order=True):
+			_transformers[key] = None
+		else:
+			_transformers[key] = Transformer.from_crs(srs, CRS.from_epsg(4326), always_xy=True)
+	return _transformers[key]
+
+def reproject_polygons(polygons, transformer):
+	''' Reprojects an array of Polygons as one flat coordinate array with ring
+	offsets, returns the reprojected Polygons and a mask of the input Polygons
+	that could be transformed '''
+	if not len(polygons):
+		# a batch of rows without geometries has no coordinate array
+		return polygons, np.zeros(0, dtype=bool)
+	geomtype, coords, offsets = shapely.to_ragged_array(polygons)
+	x, y = transformer.transform(coords[:, 0], coords[:, 1])
+	coords = np.column_stack((x, y))
+	# A Polygon fails if any of its coordinates could not be transformed
+	ringoffsets, polygonoffsets = offsets
+	coordoffsets = ringoffsets[polygonoffsets]
+	failed = np.concatenate(([0], np.cumsum(~np.isfinite(coords).all(axis=1))))
+	transformed = failed[coordoffsets[1:]] == failed[coordoffsets[:-1]]
+	reprojected = shapely.from_ragged_array(geomtype, coords, offsets)
+	return reprojected[transformed], transformed
+
+# Worker processes for the chunked simplification, shared by every conversion in the process
+_simplifypool = None
+_simplifypoollock = threading.Lock()
+
+def get_simplify_pool():
+	''' Returns the process pool for simplification or None when it is turned off '''
+	global _simplifypool
+	workers = config.simplification['workers'] or os.cpu_count() or 1
+	if workers <= 1:
+		return None
+	with _simplifypoollock:
+		if _simplifypool is None:
+			# spawned workers, forking a process that runs conversion threads is not safe
+			_simplifypool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+	return _simplifypool
+
+def reset_simplify_pool():
+	global _simplifypool
+	with _simplifypoollock:
+		_simplifypool = None
+
+def simplify_wkb(chunk, tolerance):
+	''' Simplifies a chunk of WKB geometries and returns them as WKB, runs in the worker processes '''
+	geoms = shapely.from_wkb(np.asarray(chunk, dtype=object))
+	return shapely.to_wkb(shapely.simplify(geoms, tolerance, preserve_topology=True)).tolist()
+
+def simplify_polygons(polygons, tolerance):
+	''' Simplifies an array of Polygons, layers larger than a chunk are split
+	over the worker processes as WKB and reassembled in order '''
+	chunksize = config.simplification['chunksize']
+	pool = get_simplify_pool() if len(polygons) > chunksize else None
+	if pool is None:
+		return shapely.simplify(polygons, tolerance, preserve_topology=True)
+	wkb = shapely.to_wkb(polygons)
+	chunks = [wkb[i:i + chunksize].tolist() for i in range(0, len(wkb), chunksize)]
+	simplified = np.empty(len(polygons), dtype=object)
+	try:
+		simplified[:] = [blob for chunk in pool.map(simplify_wkb, chunks, [tolerance] * len(chunks)) for blob in chunk]
+	except BrokenProcessPool as e:
+		logging.getLogger("evals logger").error("Simplification workers failed, simplifying in process: %s" % e)
+		reset_simplify_pool()
+		return shapely.simplify(polygons, tolerance, preserve_topology=True)
+	return shapely.from_wkb(simplified)
+
+def simplify_coverage(polygons, tolerance):
+	''' Simplifies an array of Polygons as a coverage: the boundaries are noded
+	into arcs that run between the points where three or more polygons meet,
+	every arc is simplified once and the faces are rebuilt from the simplified
+	arcs. Returns the rebuilt polygons, the number of arcs and the index of the
+	source Polygon of every rebuilt polygon, faces in the gaps between the
+	Polygons are removed '''
+	arcs = shapely.get_parts(shapely.line_merge(shapely.union_all(shapely.boundary(polygons))))
+	arcs = shapely.simplify(arcs, tolerance, preserve_topology=True)
+	# simplified arcs can cross, node them again before building the faces
+	faces = shapely.get_parts(shapely.polygonize(shapely.get_parts(shapely.union_all(arcs))))
+	# a face belongs to the first Polygon that contains its representative point
+	faceindex, polygonindex = shapely.STRtree(polygons).query(shapely.point_on_surface(faces), predicate='within')
+	faceindex, first = np.unique(faceindex, return_index=True)
+	faces, polygonindex = faces[faceindex], polygonindex[first]
+	# crossing arcs split a few Polygons into several faces, they are dissolved back into one
+	owners, counts = np.unique(polygonindex, return_counts=True)
+	rebuilt = faces[np.unique(polygonindex, return_index=True)[1]]
+	for i in np.flatnonzero(counts > 1):
+		rebuilt[i] = shapely.coverage_union_all(faces[polygonindex == owners[i]])
+	return rebuilt, len(arcs), owners
+
+def batched(iterable, size):
+	it = iter(iterable)
+	batch = list(islice(it, size))
+	while batch:
+		yield batch
+		batch = list(islice(it, size))
+
+class Workspace():
+	'''
+	Input, working and output directories that belong to a single conversion
+	so that concurrent conversions never see or delete each other's files.
+	Files up to config.workspace['tmpfsmaxsize'] bytes are read and simplified
+	on tmpfs when it is available, larger files in the working directory. The
+	output directory is always in the working directory, the GeoJSON, union
+	and intersection files are many times larger than the upload.
+	'''
+	def __init__(self, size=None):
+		curPath = os.path.dirname(os.path.realpath(__file__))
+		disk = os.path.join(curPath, config.working['directory'])
+		if not os.path.exists(disk):
+			os.mkdir(disk)
+		base = disk
+		tmpfs = config.workspace['tmpfs']
+		if size is not None and size <= config.workspace['tmpfsmaxsize'] and tmpfs and os.path.isdir(tmpfs):
+			base = tmpfs
+		self.roots = [tempfile.mkdtemp(prefix='evals-', dir=base)]
+		try:
+			if base != disk:
+				self.roots.append(tempfile.mkdtemp(prefix='evals-', dir=disk))
+			self.SOURCE_FILE_SHARE = os.path.join(self.roots[0], config.inputs['directory'])
+			self.WORKING_SHARE = os.path.join(self.roots[0], config.working['directory'])
+			self.OUTPUT_SHARE = os.path.join(self.roots[-1], config.geojsonoutput['directory'])
+			for folder in [self.SOURCE_FILE_SHARE, self.WORKING_SHARE, self.OUTPUT_SHARE]:
+				os.mkdir(folder)
+		except Exception:
+			self.cleanup()
+			raise
+
+	def cleanup(self):
+		for root in self.roots:
+			shutil.rmtree(root, ignore_errors=True)
+
+
+class FeatureBatch():
+	'''
+	Features carried through the pipeline as columns: an array of Shapely
+	geometries, an areatype category array with indexes into AREATYPES and a
+	float64 area array that is computed when it is first needed.
+	'''
+	AREATYPES = ['red', 'red2', 'yellow', 'green', 'green2', 'green3', 'constraints']
+
+	def __init__(self, geoms, areatypes, areas=None, coverage=False):
+		self.geoms = geoms
+		self.areatypes = areatypes
+		self._areas = areas
+		# True when the polygons do not overlap, e.g. after topology simplification
+		self.coverage = coverage
+
+	def __len__(self):
+		return len(self.geoms)
+
+	@classmethod
+	def encode_areatypes(cls, names):
+		# category code of every areatype name, -1 for unknown names
+		codes = {name: i for i, name in enumerate(cls.AREATYPES)}
+		return np.array([codes.get(name, -1) for name in names], dtype=np.int8)
+
+	@classmethod
+	def concat(cls, batches):
+		batches = list(batches)
+		if not batches:
+			return cls(np.empty(0, dtype=object), np.empty(0, dtype=np.int8))
+		return cls(np.concatenate([b.geoms for b in batches]), np.concatenate([b.areatypes for b in batches]))
+
+	@property
+	def areas(self):
+		if self._areas is None:
+			self._areas = shapely.area(self.geoms)
+		return self._areas
+
+	def filter(self, mask):
+		return FeatureBatch(self.geoms[mask], self.areatypes[mask], None if self._areas is None else self._areas[mask], self.coverage)
+
+	def with_geoms(self, geoms):
+		return FeatureBatch(geoms, self.areatypes, coverage=self.coverage)
+
+	def explode(self, return_index=False):
+		# single part Polygons, the parts that are not Polygons or are empty are
+		# removed. With return_index the source row of every part is returned too
+		parts, index = shapely.get_parts(self.geoms, return_index=True)
+		keep = (shapely.get_type_id(parts) == 3) & ~shapely.is_empty(parts)
+		exploded = FeatureBatch(parts[keep], self.areatypes[index[keep]], coverage=self.coverage)
+		return (exploded, index[keep]) if return_index else exploded
+
+	def areatype_geoms(self, areatype):
+		return self.geoms[self.areatypes == self.AREATYPES.index(areatype)]
+
+	def features(self):
+		''' (areatype, geometry) tuples, used by the writers '''
+		names = np.array(self.AREATYPES, dtype=object)[self.areatypes]
+		return zip(names.tolist(), self.geoms)
+
 
 class GeopackageHelper():
 	def __init__(self,opstatus):
 		self.logger = logging.getLogger("evals logger")
 		self.opstatus = opstatus
-		self.reprojectErrors = False
 		
 	def get_output_fname(self,fname, new_suffix, destdirectory= None):
 		path = os.path.basename(fname)
@@ -38,115 +248,40 @@ class GeopackageHelper():
 		else:
 			return os.path.join(path, fname)
 
-	def convert_gpkg_to_geojson(self,shape_fname, destdirectory):
-		"""Using the Fiona library convert GeopackageHelper to GeoJSON
+	def write_geojson(self, batch, out_fname, precision=config.precision):
+		""" Write a FeatureBatch as the final GeoJSON file
 		"""
-		features = []
-		crs = None
-		if not os.path.isfile(shape_fname):
-			self.logger.error('File not found: %s' % shape_fname)
-		self.opstatus.add_info(stage=6, msg = "Rounding coordinates to six decimal precision")
-
-
-		out_fname = os.path.join(destdirectory,os.path.basename(shape_fname).replace('.gpkg', '.geojson'))
-		with fiona.open(shape_fname, driver='GPKG') as source:
-			with fiona.open(out_fname, "w",driver='GeoJSON',crs = fiona.crs.from_epsg(4326),schema=source.schema) as sink:
-				for rec in source:
-					sink.write(rec)
+		self.opstatus.add_info(stage=6, msg = "Rounding coordinates to %s decimal precision" % precision)
+		with open(out_fname, 'w', buffering=1024 * 1024) as sink:
+			myGeoJSONWriter = ShapelyHelper.GeoJSONWriter(sink, precision=precision)
+			myGeoJSONWriter.write_featurecollection(({'areatype':areatype}, shp) for areatype, shp in batch.features())
 
 		self.logger.info('file written: %s' % out_fname)
-		self.opstatus.set_status(stage=6, status=1, statustext ="File successfully converted to GeoJSON with six decimal precision")
+		self.opstatus.set_status(stage=6, status=1, statustext ="File successfully converted to GeoJSON with %s decimal precision" % precision)
 		self.opstatus.add_success(stage=6, msg = "GeoJSON file successfully written")
 		return out_fname
 
-	def transform_coords(self,func, rec):
-		# Transform record geometry coordinates using the provided function.
-		# Returns a record or None.
-		try:
-			assert rec['geometry']['type'] == "Polygon"
-			new_coords = []
-			for ring in rec['geometry']['coordinates']:
-			    # Here is where we call func() to transform the coords.
-			    x2, y2 = func(*zip(*ring))
-			    new_coords.append(zip(x2, y2))
-			rec['geometry']['coordinates'] = new_coords
-			return rec
-		except Exception as e:
-		    # Writing untransformed features to a different shapefile
-		    # is another option.
-
-			self.reprojectErrors = True
-			self.logger.error(
-			    "Error transforming record.")
-			return None
-
-	def clean_geom(self,rec):
-		# Ensure that record geometries are valid and "clean".
-		# Returns a record or None.
-
-		try:
-		    geom = shape(rec['geometry'])
-		    print(rec)
-		    if not geom.is_valid:
-		        clean = geom.buffer(0.0)
-		        assert clean.is_valid
-		        assert clean.geom_type in ['Polygon','MultiPolygon']
-		        geom = clean
-		    rec['geometry'] = mapping(geom)
-		    return rec
-		except Exception as e:
-			print(e)
-		    # Writing uncleanable features to a different shapefile
-		    # is another option.
-			self.reprojectErrors = True
-			self.opstatus.add_warning(stage=4, msg = "Error in reprojecting record in the file, please check for geometry errors and reproject to EPSG:4326 in GIS and try again.")
-			# self.logger.error(
-		        # "Error cleaning record %s:", e)
-			
-			return None
+	def write_geopackage(self, batch, out_fname, crs):
+		""" Write a FeatureBatch to a Geopackage, used to inspect the intermediate stages
+		"""
+		polygonschema = {
+		    'geometry': 'Polygon',
+		    'properties': {'areatype':'str'}
+		}
+		with collection(out_fname, 'w', driver='GPKG',crs=crs, schema=polygonschema) as c:
+			for areatype, shp in batch.features():
+				c.write({
+					'geometry': mapping(shp), 
+					'properties': {'areatype':areatype}
+				})
+		self.logger.info('file written: %s' % out_fname)
+		return out_fname
 
-	def reproject_to_4326(self, shape_fname, outputdirectory):
-		
-		output = self.get_output_fname(shape_fname, '_4326', outputdirectory)
-		with fiona.open(shape_fname, "r") as source:
-			with fiona.open(
-					output,
-					"w",
-					driver='GPKG',
-					schema=source.schema,
-					crs = from_epsg(4326)
-					) as sink:
-				
-				origproj = Proj(source.crs, preserve_units=True)
-				
-				func = functools.partial(
-					self.transform_coords,
-					functools.partial(
-						transform, 
-						origproj, 
-						Proj(sink.crs) ) 
-					)
-				# Transform the input records, using imap to loop/generate.
-				results = map(func, source)
-				# The transformed record generator is used as input for a
-				# "cleaning" generator.
-
-				# results = map(self.clean_geom, results)
-				# Remove null records from the results
-				results = filter(bool, results)
-				# Finally we write records from the last generator to the output
-				# "sink" file.
-
-	
-				sink.writerecords(results)
-				
-				
-		return output, self.reprojectErrors
-				
 	def validateSchema(self, schema):
 
 		try: 
-			assert schema['geometry'] in ['Polygon' , 'MultiPolygon']
+			# the Z coordinates of 3D polygons are dropped when the features are read
+			assert schema['geometry'] in ['Polygon' , 'MultiPolygon', '3D Polygon', '3D MultiPolygon']
 			validated = True
 		except AssertionError as e: 
 			validated = False
@@ -154,154 +289,360 @@ class GeopackageHelper():
 
 		return validated
 		
-	def validateFeatures(self, allfeats, evalorimpact='eval'):
-		validated = False
+	def validateAreatypes(self, areatypes, evalorimpact='eval'):
+		# areatypes is an array of FeatureBatch category codes
 		checkDict = {'eval':['red', 'green', 'yellow', 'green2','green3']}
-		toCheck = checkDict[evalorimpact]
-		for f in allfeats:
-			if 'areatype' in f['properties'].keys() and f['properties']['areatype'] in toCheck:
-				validated = True
-			else:
-				validated = False
-		return validated
+		toCheck = FeatureBatch.encode_areatypes(checkDict[evalorimpact])
+		return bool(np.isin(areatypes, toCheck).all())
+
+
+class GeopackageReader():
+	'''
+	Reads the areatypes and geometries of a Geopackage layer straight from its
+	SQLite feature table. The GeoPackage binary header is stripped from every
+	geometry blob and the WKB that follows it is decoded in one
+	shapely.from_wkb call per batch, no coordinates are converted to Python
+	objects.
+	'''
+	# bytes of the envelope for every envelope indicator in the header flags
+	ENVELOPESIZES = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+
+	def __init__(self, filepath, layer=None):
+		self.filepath = filepath
+		self.layer = layer
+
+	def geometry_column(self, conn):
+		for table, column in conn.execute('SELECT table_name, column_name FROM gpkg_geometry_columns').fetchall():
+			if self.layer is None or table == self.layer:
+				return table, column
+		raise sqlite.OperationalError("Layer %s has no geometry column" % self.layer)
+
+	def read(self, batchsize):
+		''' Returns a generator of (areatypes, geometries) batches, the errors in
+		opening the feature table are raised here before any batch is read '''
+		conn = sqlite.connect('file:%s?mode=ro' % self.filepath, uri=True)
+		try:
+			table, column = self.geometry_column(conn)
+			cursor = conn.execute('SELECT "areatype", "%s" FROM "%s"' % (column, table))
+		except sqlite.Error:
+			conn.close()
+			raise
+		return self.batches(conn, cursor, batchsize)
+
+	def batches(self, conn, cursor, batchsize):
+		try:
+			while True:
+				rows = cursor.fetchmany(batchsize)
+				if not rows:
+					break
+				areatypes, blobs = zip(*rows)
+				yield list(areatypes), self.geometries(blobs)
+		finally:
+			conn.close()
+
+	@classmethod
+	def strip_header(cls, blob):
+		# magic, version, flags and srs id are followed by the envelope, flag bit 4 marks an empty geometry
+		if blob is None or blob[:2] != b'GP' or blob[3] & 0x10:
+			return None
+		envelope = cls.ENVELOPESIZES.get((blob[3] >> 1) & 0x07)
+		if envelope is None:
+			return None
+		return blob[8 + envelope:]
+
+	@classmethod
+	def geometries(cls, blobs):
+		wkb = np.empty(len(blobs), dtype=object)
+		wkb[:] = [cls.strip_header(blob) for blob in blobs]
+		return shapely.force_2d(shapely.from_wkb(wkb, on_invalid='ignore'))
 
 
 class FileOperations():
-	def __init__(self, SOURCE_FILE_SHARE, OUTPUT_SHARE, WORKING_SHARE, opstatus):
+	'''
+	Streams the features of a Geopackage through the conversion stages: every
+	feature is read once and passed through validate -> explode -> reproject ->
+	simplify -> serialize in memory as FeatureBatches. Only the final GeoJSON
+	is written, the intermediate Geopackages are written only when debug is set.
+	'''
+	def __init__(self, SOURCE_FILE_SHARE, OUTPUT_SHARE, WORKING_SHARE, opstatus, debug=False, options=None):
 		self.SOURCE_FILE_SHARE = SOURCE_FILE_SHARE
 		self.WORKING_SHARE = WORKING_SHARE
 		self.OUTPUT_SHARE = OUTPUT_SHARE
 		self.logger = logging.getLogger("evals logger")
 		self.opstatus = opstatus
+		self.debug = debug
+		self.options = options if options else ConversionOptions()
 		self.myShpFileHelper = GeopackageHelper(self.opstatus)
 		self.myShapeFactory = ShapelyHelper.ShapesFactory()
+		self.featuresvalidate = False
+		self.reprojectErrors = False
 
-	def multipart_to_singlepart(self, filepath):
-		allGeoms =[]
-		with fiona.open(filepath, driver='GPKG') as allfeats:
-			crs = allfeats.crs
-			for curFeat in allfeats:
-				s = self.myShapeFactory.genFeature(curFeat['geometry'])
-				if s:
-					allGeoms.append({'shp':s, 'areatype':curFeat['properties']['areatype']})
-		fg = []
-		for curGeom in allGeoms:	
-			shp = curGeom['shp']
-			if shp.geom_type == 'MultiPolygon':
-				polys = list(shp)
-				for shp1 in polys: 							
-					s = {'shp': shp1 , 'areatype': curGeom['areatype']}							
-					fg.append(s)
-			elif shp.geom_type == 'Polygon':
-				s = {'shp': shp1 , 'areatype': curGeom['areatype']}		
-				fg.append(s)
-
-
-		sp = self.myShpFileHelper.get_output_fname(filepath,'_sp', self.WORKING_SHARE)
-		
-		# Define a polygon feature geometry with one attribute
-		polygonschema = {
-		    'geometry': 'Polygon',
-		    'properties': {'areatype':'str'}
-		}
-
-		with collection(sp, 'w', driver='GPKG',crs=crs, schema=polygonschema) as c:
-			## If there are multiple geometries, put the "for" loop here
-			for curPoly in fg:				
-				c.write({
-					'geometry': mapping(curPoly['shp']), 
-					'properties': {'areatype':curPoly['areatype']}
-				})
-		return sp
-
-	def reprojectFile(self, filepath):
-		reprojectionErrors = False
-		with fiona.open(filepath, driver='GPKG') as allfeats:
-			# get the schema
-			schema = allfeats.schema
-			# get the crs
-			crs = allfeats.crs
-			if (('init' in crs) and (crs['init'] == 'epsg:4326')):
-				reprojected_fname= filepath
-			else:
-					self.logger.info("Reprojecting file")
-					self.opstatus.add_info(stage=4, msg = "Checking projection..")
-					self.opstatus.add_info(stage=4, msg = "Reprojecting file to EPSG 4326 projection")
-					
-					reprojected_fname, reprojectionErrors  = self.myShpFileHelper.reproject_to_4326(filepath, self.WORKING_SHARE)
-
-		return reprojected_fname, reprojectionErrors
-
-	def simplifyReprojectedFile(self, reprojectedfilepath):    
-        # simplify reprojected file
-
-		with fiona.open(reprojectedfilepath,driver='GPKG') as allfeats:
-			crs = allfeats.crs
-			bounds = allfeats.bounds
-			simplification = {'highest': 0.01,'high': 0.005, 'medium':0.001, 'low':0.0005, 'default':0.00001,'none':0}
-			# simplify the file
-			allGeoms = []
-			errorCounter = 0
-
-			# Define a polygon feature geometry with one attribute
-			polygonschema = {
-			    'geometry': 'Polygon',
-			    'properties': {'areatype':'str'}
-			}
-			simplificationlevel = simplification[config.simplificationlevel]
-			self.logger.info("Simplifying with simplification level : %s " % config.simplificationlevel)
-			self.opstatus.add_info(stage=5, msg = "Simplifying with simplification level : %s " % config.simplificationlevel)
-			for curFeat in allfeats:
-				s = self.myShapeFactory.genFeature(curFeat['geometry'])
-				if s:
-					area = s.area
-					allGeoms.append({'area': area, 'shp':s, 'areatype':curFeat['properties']['areatype']})
-		simshp = []
+	def read_records(self, source):
+		# Batches of areatype names and 2D geometries, read from the feature table
+		# directly or through Fiona's records if the table cannot be read
+		try:
+			batches = GeopackageReader(source.path, source.name).read(config.reprojection['batchsize'])
+		except sqlite.Error as e:
+			self.logger.error("Error in reading the feature table, reading the records with Fiona %s" % e)
+			batches = None
+		if batches is not None:
+			for batch in batches:
+				yield batch
+			return
+		for records in batched(source, config.reprojection['batchsize']):
+			yield [curFeat['properties'].get('areatype') for curFeat in records], self.myShapeFactory.genFeatures([curFeat['geometry'] for curFeat in records])
+
+	def read_features(self, source):
+		# Validate the areatypes of every batch of records and yield 2D FeatureBatches
+		self.featuresvalidate = False
+		numfeatures = 0
+		records = self.read_records(source)
+		while True:
+			# reading and validating are measured as stage 3, the later stages run between the batches
+			with self.opstatus.measure(3) as profile:
+				try:
+					areatypes, geoms = next(records)
+				except StopIteration:
+					break
+				areatypes = FeatureBatch.encode_areatypes(areatypes)
+				if not self.myShpFileHelper.validateAreatypes(areatypes):
+					self.featuresvalidate = False
+					return
+				numfeatures += len(areatypes)
+				batch = FeatureBatch(geoms, areatypes).filter(~shapely.is_missing(geoms))
+				profile['featuresin'] = len(areatypes)
+				profile['featuresout'] = len(batch)
+				profile['verticesin'] = profile['verticesout'] = shapely.get_num_coordinates(batch.geoms).sum()
+			yield batch
+		self.featuresvalidate = numfeatures > 0
+
+	def multipart_to_singlepart(self, batches):
+		for batch in batches:
+			with self.opstatus.measure(3):
+				batch = batch.explode()
+			yield batch
+
+	def reproject(self, batches, crs):
+		transformer = get_transformer(crs)
+		if transformer is None:
+			return batches
+		self.logger.info("Reprojecting file")
+		self.opstatus.add_info(stage=4, msg = "Checking projection..")
+		self.opstatus.add_info(stage=4, msg = "Reprojecting file to EPSG 4326 projection")
+		return self.reproject_batches(batches, transformer)
+
+	def reproject_batches(self, batches, transformer):
+		# Transform the batches and remove the features that failed
+		for batch in batches:
+			with self.opstatus.measure(4) as profile:
+				reprojected, transformed = reproject_polygons(batch.geoms, transformer)
+				if not transformed.all():
+					self.reprojectErrors = True
+					self.logger.error("Error transforming %s records." % np.count_nonzero(~transformed))
+					self.opstatus.add_warning(stage=4, msg = "Error in reprojecting %s features in the file, please check for geometry errors and reproject to EPSG:4326 in GIS and try again." % np.count_nonzero(~transformed))
+				profile['featuresin'], profile['featuresout'] = len(batch), len(reprojected)
+				profile['verticesin'] = shapely.get_num_coordinates(batch.geoms).sum()
+				profile['verticesout'] = shapely.get_num_coordinates(reprojected).sum()
+			yield FeatureBatch(reprojected, batch.areatypes[transformed])
+
+	def simplify(self, batch):
+		simplification = {'highest': 0.01,'high': 0.005, 'medium':0.001, 'low':0.0005, 'default':0.00001,'none':0}
+		simplificationlevel = self.options.simplificationlevel if self.options.tolerance is None else self.options.tolerance
+		self.logger.info("Simplifying with simplification level : %s " % simplificationlevel)
+		self.opstatus.add_info(stage=5, msg = "Simplifying with simplification level : %s " % simplificationlevel)
+
+		if not len(batch):
+			return batch
 		# # filter out small areas
-		
-		maxareadict =  max(allGeoms, key=lambda x:x['area'])
-		maxarea =  maxareadict['area']
-		areathreshold = (maxarea * 0.005)
-
-		allGeoms = [i for i in allGeoms if i['area'] > areathreshold]
-		
-		for curGeom in allGeoms:				
-			try:
-				assert simplificationlevel != 'none'
-				shp = curGeom['shp'].simplify(simplificationlevel, preserve_topology=True)
-			except AssertionError as e: 					
-			    shp = curGeom['shp']
-			else:
-				if shp.geom_type == 'MultiPolygon':
-					polys = list(shp)
-					for shp1 in polys: 							
-						s = {'shp': shp1 , 'areatype': curGeom['areatype']}							
-						simshp.append(s)
-
-				else:
-					s = {'shp': shp , 'areatype': curGeom['areatype']}
-					simshp.append(s)
+		areathreshold = (batch.areas.max() * self.options.areathreshold)
+		batch = batch.filter(batch.areas > areathreshold)
 
+		if self.options.tolerance is not None:
+			tolerances = {areatype: self.options.tolerance for areatype in FeatureBatch.AREATYPES}
+		elif self.options.simplificationlevel == 'adaptive':
+			tolerances = self.adaptive_tolerances(batch, simplification['default'], simplification['highest'])
+		else:
+			tolerances = {areatype: simplification[self.options.simplificationlevel] for areatype in FeatureBatch.AREATYPES}
 
-		sims = self.myShpFileHelper.get_output_fname(reprojectedfilepath,'_sim', self.WORKING_SHARE )
-		
-		self.logger.info("Writing simplified Geopackage %s.." % sims) 
-		self.opstatus.add_info(stage=5, msg = "Writing simplified Geopackage")
-		
+		if self.options.simplificationmode == 'topology':
+			# the shared boundaries are simplified once, with the smallest tolerance of the layers they separate
+			simplificationlevel = min([tolerances[FeatureBatch.AREATYPES[code]] for code in np.unique(batch.areatypes)] or [0])
+			if simplificationlevel:
+				batch = self.simplify_topology(batch, simplificationlevel)
+		else:
+			geoms = batch.geoms.copy()
+			for simplificationlevel in set(tolerances.values()):
+				mask = np.isin(batch.areatypes, FeatureBatch.encode_areatypes([k for k, v in tolerances.items() if v == simplificationlevel]))
+				if simplificationlevel and mask.any():
+					geoms[mask] = simplify_polygons(batch.geoms[mask], simplificationlevel)
+			batch = batch.with_geoms(geoms).explode()
+
+		self.opstatus.set_status(stage=5, status=1, statustext ="Features simplified successfully")
+		self.opstatus.add_success(stage=5, msg = "Features simplified successfully")
+		return batch
+
+	def vertex_budget(self):
+		# The tightest of the configured budgets as a number of output vertices
+		budgets = []
+		adaptive = config.adaptivesimplification
+		if adaptive['vertices']:
+			budgets.append(adaptive['vertices'])
+		if adaptive['bytes']:
+			# a vertex is written as [x,y], with a sign and up to three integer digits per ordinate
+			budgets.append(adaptive['bytes'] / (2 * (self.options.precision + 5) + 3))
+		return min(budgets) if budgets else None
+
+	def layer_vertex_limit(self, batch):
+		# The vertices a layer can keep while a diagram at the 95th percentile of the performance test is intersected within p95seconds
+		adaptive = config.adaptivesimplification
+		if not adaptive['p95test'] or not self.options.performancetest or not len(batch):
+			return None
+		share = ShapelyHelper.WorkloadSimulator.diagram_share(shapely.total_bounds(batch.geoms))
+		return config.performance['p95seconds'] * adaptive['verticespersecond'] / share
+
+	def adaptive_tolerances(self, batch, mintolerance, maxtolerance):
+		''' Searches the smallest tolerance for every areatype layer that keeps the
+		layer within its share of the vertex budget and within the vertices the
+		performance test can intersect in time. The vertex count of a tolerance
+		is estimated by simplifying a sample of the layer. '''
+		budget = self.vertex_budget()
+		layerlimit = self.layer_vertex_limit(batch)
+		tolerances = {areatype: mintolerance for areatype in FeatureBatch.AREATYPES}
+		if budget is None and layerlimit is None:
+			self.logger.error("Adaptive simplification has no budget, using the default tolerance")
+			return tolerances
+		vertices = shapely.get_num_coordinates(batch.geoms)
+		totalvertices = vertices.sum()
+		rng = np.random.default_rng(0)
+		for code, areatype in enumerate(FeatureBatch.AREATYPES):
+			layer = np.flatnonzero(batch.areatypes == code)
+			if not len(layer):
+				continue
+			layervertices = vertices[layer].sum()
+			# every layer is reduced by the same share, a diagram is intersected with the union of one layer at a time
+			layerbudgets = [budget * layervertices / float(totalvertices)] if budget is not None else []
+			if layerlimit is not None:
+				layerbudgets.append(layerlimit)
+			layerbudget = min(layerbudgets)
+			sample = batch.geoms[rng.choice(layer, min(len(layer), config.adaptivesimplification['samplesize']), replace=False)]
+			scale = layervertices / float(shapely.get_num_coordinates(sample).sum())
+
+			def estimate(tolerance):
+				return shapely.get_num_coordinates(shapely.simplify(sample, tolerance, preserve_topology=True)).sum() * scale
+
+			if estimate(mintolerance) <= layerbudget:
+				tolerance = mintolerance
+			elif estimate(maxtolerance) > layerbudget:
+				tolerance = maxtolerance
+				self.opstatus.add_warning(stage=5, msg = "The %s layer is over its vertex budget even at the highest simplification level" % areatype)
+			else:
+				# bisect the tolerance on a log scale
+				low, high = np.log10(mintolerance), np.log10(maxtolerance)
+				for i in range(config.adaptivesimplification['iterations']):
+					mid = (low + high) / 2
+					if estimate(10 ** mid) <= layerbudget:
+						high = mid
+					else:
+						low = mid
+				tolerance = float(10 ** high)
+			tolerances[areatype] = tolerance
+			self.opstatus.add_info(stage=5, msg = "Adaptive simplification chose a tolerance of %.8f for the %s layer, about %d of %d vertices" % (tolerance, areatype, estimate(tolerance), layervertices))
+		return tolerances
+
+	def simplify_topology(self, batch, simplificationlevel):
+		# Simplify the shared boundaries once, the independent simplification is used if the faces cannot be rebuilt
 		try:
-			with collection(sims, 'w', driver='GPKG',crs=crs, schema=polygonschema) as c:
-				## If there are multiple geometries, put the "for" loop here
-				for curPoly in simshp:				
-
-					c.write({
-						'geometry': mapping(curPoly['shp']), 
-						'properties': {'areatype':curPoly['areatype']}
-					})
-			
-			self.opstatus.set_status(stage=5, status=1, statustext ="Simplifed Geopackage written successfully")
-			self.opstatus.add_success(stage=5, msg = "Simplifed file written successfully")
-		except Exception as e: 
-			self.opstatus.set_status(stage=5, status=0, statustext ="Error in writing simplified Geopackage")
-			self.opstatus.add_error(stage=5, msg = "Error in writing simplified Geopackage" %e)
-
-		return sims, bounds
\ No newline at end of file
+			faces, numarcs, index = simplify_coverage(batch.geoms, simplificationlevel)
+			if not shapely.is_valid(faces).all():
+				raise ValueError("%s rebuilt faces are not valid" % np.count_nonzero(~shapely.is_valid(faces)))
+		except Exception as e:
+			self.logger.error("Error in topology simplification %s" % e)
+			self.opstatus.add_warning(stage=5, msg = "Shared boundaries could not be simplified, polygons are simplified independently")
+			return batch.with_geoms(simplify_polygons(batch.geoms, simplificationlevel)).explode()
+		self.opstatus.add_info(stage=5, msg = "Simplified %s shared boundaries and rebuilt %s polygons" % (numarcs, len(faces)))
+		return FeatureBatch(faces, batch.areatypes[index], coverage=True).explode()
+
+	def calculate_bounds(self, batch):
+		if not len(batch):
+			return (0, 0, 0, 0)
+		return tuple(shapely.total_bounds(batch.geoms).tolist())
+
+	def quantize(self, batch):
+		# Snap the coordinates to the output grid in one vectorized pass, GEOS
+		# removes the repeated vertices and repairs the rings that collapse.
+		gridsize = self.options.gridsize
+		if not len(batch) or not gridsize:
+			return batch, None
+		try:
+			snapped = shapely.set_precision(batch.geoms, gridsize)
+		except shapely.errors.GEOSException as e:
+			# invalid polygons cannot be snapped, they are written as they are
+			valid = shapely.is_valid(batch.geoms)
+			self.logger.error("Error in snapping coordinates %s" % e)
+			self.opstatus.add_warning(stage=6, msg = "%s invalid features were not snapped to the output grid" % np.count_nonzero(~valid))
+			snapped = batch.geoms.copy()
+			snapped[valid] = shapely.set_precision(batch.geoms[valid], gridsize)
+		quantized, index = batch.with_geoms(snapped).explode(return_index=True)
+		stats = {
+			'gridsize': gridsize,
+			'coordsbefore': int(shapely.get_num_coordinates(batch.geoms).sum()),
+			'coordsafter': int(shapely.get_num_coordinates(quantized.geoms).sum()),
+			'collapsed': int(len(batch) - len(np.unique(index))),
+			# average characters per ordinate at full precision, estimated from a sample
+			'fullprecisionchars': float(np.mean([len(repr(float(v))) for v in shapely.get_coordinates(batch.geoms[:100]).ravel()]))
+		}
+		return quantized, stats
+
+	def report_quantization(self, stats, gjFile):
+		written = os.path.getsize(gjFile)
+		# the same file at full precision has the original vertices with full length ordinates
+		quantizedchars = self.options.precision + 4
+		fullsize = written + 2 * (stats['coordsbefore'] * stats['fullprecisionchars'] - stats['coordsafter'] * quantizedchars)
+		saved = max(fullsize - written, 0)
+		self.opstatus.add_info(stage=6, msg = "Snapped coordinates to a %s degree grid, removed %s duplicate vertices and %s collapsed polygons" % (stats['gridsize'], stats['coordsbefore'] - stats['coordsafter'], stats['collapsed']))
+		self.opstatus.add_info(stage=6, msg = "GeoJSON is %s bytes, about %d bytes (%.1f%%) smaller than at full precision" % (written, saved, 100.0 * saved / fullsize if fullsize else 0))
+
+	def debug_write(self, batches, filepath, suffix, crs):
+		# Materialize a stage and write it as an intermediate Geopackage for inspection
+		batch = FeatureBatch.concat(batches) if not isinstance(batches, FeatureBatch) else batches
+		sp = self.myShpFileHelper.get_output_fname(filepath, suffix, self.WORKING_SHARE)
+		self.myShpFileHelper.write_geopackage(batch, sp, crs)
+		return [batch]
+
+	def convert_file(self, source, filepath, layer=None):
+		''' Convert an open Geopackage in a single pass, returns the converted
+		FeatureBatch, the GeoJSON file it is written to, the bounds of the
+		reprojected features and whether there were reprojection errors. The
+		batch is None if the features do not validate. The output files of a
+		layer are suffixed with its name. '''
+		crs = source.crs
+		suffix = '_' + layer if layer else ''
+		batches = self.multipart_to_singlepart(self.read_features(source))
+		if self.debug:
+			batches = self.debug_write(batches, filepath, suffix + '_sp', crs)
+		batches = self.reproject(batches, crs)
+		# The area threshold needs the largest feature, so the reprojected
+		# features are held in memory from here on
+		batch = FeatureBatch.concat(batches)
+		if not self.featuresvalidate:
+			return None, None, None, self.reprojectErrors
+		if self.debug:
+			self.debug_write(batch, filepath, suffix + '_4326', from_epsg(4326))
+		bounds = self.calculate_bounds(batch)
+
+		with self.opstatus.measure(5) as profile:
+			profile['featuresin'], profile['verticesin'] = len(batch), shapely.get_num_coordinates(batch.geoms).sum()
+			batch = self.simplify(batch)
+			profile['featuresout'], profile['verticesout'] = len(batch), shapely.get_num_coordinates(batch.geoms).sum()
+		if self.debug:
+			self.debug_write(batch, filepath, suffix + '_sim', from_epsg(4326))
+
+		with self.opstatus.measure(6) as profile:
+			profile['featuresin'], profile['verticesin'] = len(batch), shapely.get_num_coordinates(batch.geoms).sum()
+			batch, quantizestats = self.quantize(batch)
+			gjFile = os.path.join(self.OUTPUT_SHARE, os.path.basename(filepath).replace('.gpkg', suffix + '.geojson'))
+			self.myShpFileHelper.write_geojson(batch, gjFile, precision=self.options.precision)
+			profile['featuresout'], profile['verticesout'] = len(batch), shapely.get_num_coordinates(batch.geoms).sum()
+		if quantizestats:
+			self.report_quantization(quantizestats, gjFile)
+		return batch, gjFile, bounds, self.reprojectErrors
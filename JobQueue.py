@@ -0,0 +1,164 @@
+import config
+import EvaluationConverter
+import EvaluationFileOps
+import CacheHelper
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import threading
+import cProfile
+import logging
+import json
+import uuid
+import time
+import os
+
+
+class ConversionJob():
+    '''
+    A single uploaded Geopackage waiting for or going through the conversion.
+    The converter's OpStatus is updated by the worker as the stages complete
+    so it can be polled while the job is running.
+
+    State:
+    queued - waiting for a worker
+    running - conversion in progress
+    finished - conversion complete, the GeoJSON is available
+    failed - the conversion raised an unexpected error
+    '''
+    def __init__(self, filename, data, cachekey=None, options=None):
+        self.jobid = uuid.uuid4().hex
+        self.filename = filename
+        self.data = data
+        self.cachekey = cachekey
+        self.options = options
+        self.state = 'queued'
+        self.msg = "File Uploaded successfully"
+        # GeoJSON text of every file and layer
+        self.gj = {}
+        self.status = None
+        self.cached = False
+        self.profile = None
+        self.created = time.time()
+        self.finished = None
+        self.logger = logging.getLogger("evals logger")
+        self.opstatus = EvaluationConverter.OpStatus()
+
+    def run(self, resultcache=None):
+        self.state = 'running'
+        converter = None
+        try:
+            # creating the workspace fails when tmpfs or the working directory are full or not writable
+            converter = EvaluationConverter.ConvertEvaluation(workspace=EvaluationFileOps.Workspace(size=len(self.data)), opstatus=self.opstatus, options=self.options)
+            with open(os.path.join(converter.SOURCE_FILE_SHARE, self.filename), 'wb') as f:
+                f.write(self.data)
+            self.data = None
+            if config.profiling['cprofile']:
+                self.gj, status = self.run_profiled(converter)
+            else:
+                self.gj, status = converter.convert()
+            self.status = json.loads(status)
+            self.state = 'finished'
+            if resultcache and self.cachekey:
+                resultcache.put(self.cachekey, self.gj, converter.unions, status)
+        except Exception as e:
+            self.logger.error("Error in conversion job %s: %s" % (self.jobid, e))
+            self.msg = "Error in converting the Geopackage, please try again."
+            self.state = 'failed'
+        finally:
+            self.data = None
+            self.finished = time.time()
+            if converter is not None:
+                converter.cleanDirectories()
+
+    def run_profiled(self, converter):
+        # only the conversion thread is profiled, the GEOS work in the worker threads shows up as waiting
+        directory = os.path.join(os.path.dirname(os.path.realpath(__file__)), config.profiling['directory'])
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(converter.convert)
+        finally:
+            self.profile = os.path.join(directory, self.jobid + '.prof')
+            profiler.dump_stats(self.profile)
+
+    def load_cached(self, cached):
+        self.data = None
+        # the cache key leaves out the filename, the result is returned under the name of this upload
+        self.gj = {self.filename: layers for layers in cached['gj'].values()}
+        self.status = json.loads(cached['status'])
+        self.cached = True
+        self.state = 'finished'
+        self.finished = time.time()
+
+    def is_done(self):
+        return self.state in ['finished', 'failed']
+
+    def result_size(self):
+        # characters of GeoJSON text held for the job
+        return sum(len(layergj) for layers in self.gj.values() for layergj in layers.values())
+
+    def get_status(self):
+        status = self.status if self.status else json.loads(self.opstatus.get_allstatuses())
+        result = {'jobid': self.jobid, 'state': self.state, 'msg': self.msg, 'cached': self.cached, 'status': status}
+        if self.profile:
+            result['profile'] = self.profile
+        return result
+
+
+class JobQueue():
+    '''
+    Runs conversions on a local pool of worker threads so that uploads return
+    right away. Uploads that were converted before with the same settings are
+    finished at once from the result cache. At most maxqueued uploads wait for
+    a worker. Finished jobs are kept for polling for maxage seconds, the oldest
+    are dropped first when there are more than maxjobs of them or their
+    GeoJSON is larger than maxbytes. Jobs are expired when a job finishes and
+    when a job is polled.
+    '''
+    def __init__(self, workers=config.jobs['workers'], maxjobs=config.jobs['maxjobs'], maxage=config.jobs['maxage'], maxbytes=config.jobs['maxbytes'], maxqueued=config.jobs['maxqueued'], resultcache=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.maxjobs = maxjobs
+        self.maxage = maxage
+        self.maxbytes = maxbytes
+        self.maxqueued = maxqueued
+        self.resultcache = resultcache if resultcache else CacheHelper.ResultCache()
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, filename, data, options=None):
+        ''' Returns the job of an upload or None when maxqueued uploads are already waiting for a worker '''
+        job = ConversionJob(filename, data, CacheHelper.content_key(data, EvaluationConverter.cache_settings(options)), options)
+        cached = self.resultcache.get(job.cachekey)
+        if cached:
+            job.load_cached(cached)
+        with self.lock:
+            if not cached and len([queued for queued in self.jobs.values() if queued.state == 'queued']) >= self.maxqueued:
+                return None
+            self.jobs[job.jobid] = job
+            self.expire()
+        if not cached:
+            self.executor.submit(job.run, self.resultcache).add_done_callback(self.job_done)
+        return job
+
+    def job_done(self, future):
+        with self.lock:
+            self.expire()
+
+    def get(self, jobid):
+        with self.lock:
+            self.expire()
+            return self.jobs.get(jobid)
+
+    def expire(self):
+        # finished jobs in the order they finished, the newest one is kept whatever its size
+        done = sorted([job for job in self.jobs.values() if job.finished is not None], key=lambda job: job.finished)
+        now = time.time()
+        count = len(done)
+        size = sum(job.result_size() for job in done)
+        for i, job in enumerate(done):
+            newest = i == len(done) - 1
+            if now - job.finished > self.maxage or count > self.maxjobs or (size > self.maxbytes and not newest):
+                del self.jobs[job.jobid]
+                count -= 1
+                size -= job.result_size()
@@ -1,12 +1,31 @@
 from shapely.geometry.base import BaseGeometry
-from shapely.geometry import shape, mapping, shape, asShape
+from shapely.geometry import shape, mapping, shape
 from shapely.geometry import *
 from shapely.validation import explain_validity
 
 from shapely.ops import unary_union
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from rtree import index as rtreeindex
+import shapely
+import config
+import itertools
 import json
 import logging
-from shapely import speedups
+import math
+import statistics
+import time
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+def peak_memory():
+    # peak resident set size of the process in MB, GEOS allocations included
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
 
 class ShapelyEncoder(json.JSONEncoder):
 
@@ -37,6 +56,81 @@ def load_from_JSON(json_string):
     '''Read JSON and a create a SHapely Object '''
     return json.loads(json_string, cls=ShapelyDecoder)
 
+
+class GeoJSONWriter():
+    '''
+    Writes GeoJSON features to a file straight from the coordinate arrays of
+    the Shapely geometries, without building mapping() dicts or intermediate
+    JSON strings. Coordinates are written with precision decimals. Polygons
+    and MultiPolygons take the fast path, the coordinates of a chunk of them
+    are read from a single ragged array. Other geometries are written
+    through mapping().
+    '''
+    def __init__(self, sink, precision=config.precision):
+        self.sink = sink
+        self.coordformat = '[%.{0}f,%.{0}f]'.format(precision)
+        self.ringformats = {}
+
+    def ring_format(self, numcoords):
+        fmt = self.ringformats.get(numcoords)
+        if fmt is None:
+            fmt = '[' + ','.join([self.coordformat] * numcoords) + ']'
+            self.ringformats[numcoords] = fmt
+        return fmt
+
+    def polygon_format(self, ringoffsets, first, last):
+        # format string for the rings first to last of a ragged coordinate array
+        return '[' + ','.join([self.ring_format(ringoffsets[i + 1] - ringoffsets[i]) for i in range(first, last)]) + ']'
+
+    def format_polygons(self, geoms):
+        # all the geometries are Polygons or all are MultiPolygons, their coordinates come from a single ragged array
+        # the output is 2D, Z coordinates would shift the pairs the format strings expect
+        geomtype, coords, offsets = shapely.to_ragged_array(geoms, include_z=False)
+        coords = coords.ravel().tolist()
+        ringoffsets = offsets[0].tolist()
+        polygonoffsets = offsets[1].tolist()
+        multipolygon = len(offsets) == 3
+        partoffsets = offsets[2].tolist() if multipolygon else range(len(geoms) + 1)
+        header = '{"type": "%s", "coordinates": ' % ('MultiPolygon' if multipolygon else 'Polygon')
+        formatted = []
+        for i in range(len(geoms)):
+            first, last = partoffsets[i], partoffsets[i + 1]
+            if multipolygon:
+                fmt = '[' + ','.join([self.polygon_format(ringoffsets, polygonoffsets[j], polygonoffsets[j + 1]) for j in range(first, last)]) + ']'
+            else:
+                fmt = self.polygon_format(ringoffsets, polygonoffsets[first], polygonoffsets[last])
+            # every coordinate of a geometry is formatted in a single operation
+            start, end = ringoffsets[polygonoffsets[first]] * 2, ringoffsets[polygonoffsets[last]] * 2
+            formatted.append(header + (fmt % tuple(coords[start:end])) + '}')
+        return formatted
+
+    def format_geometries(self, geoms):
+        ''' GeoJSON strings of a list of geometries '''
+        formatted = [None] * len(geoms)
+        for geomtype in ['Polygon', 'MultiPolygon']:
+            idx = [i for i, geom in enumerate(geoms) if geom.geom_type == geomtype and not geom.is_empty]
+            if idx:
+                for i, text in zip(idx, self.format_polygons([geoms[i] for i in idx])):
+                    formatted[i] = text
+        for i, geom in enumerate(geoms):
+            if formatted[i] is None:
+                formatted[i] = json.dumps(mapping(geom))
+        return formatted
+
+    def write_featurecollection(self, features, chunksize=1000):
+        ''' Write an iterable of (properties, geometry) tuples as a FeatureCollection, chunksize features are formatted together '''
+        self.sink.write('{"type": "FeatureCollection", "features": [')
+        separator = ''
+        features = iter(features)
+        while True:
+            chunk = list(itertools.islice(features, chunksize))
+            if not chunk:
+                break
+            for (properties, geom), text in zip(chunk, self.format_geometries([geom for properties, geom in chunk])):
+                self.sink.write(separator + '{"type": "Feature", "properties": ' + json.dumps(properties) + ', "geometry": ' + text + '}')
+                separator = ', '
+        self.sink.write(']}')
+
 class GeomOperations():
     def __init__(self):
         self.logger = logging.getLogger("evals logger")
@@ -65,113 +159,229 @@ class GeomOperations():
         curFeature['geometry']= json.loads(featureJSON)
         return curFeature
 
-    def checkIntersection(self, planLayer, evalLayer,layerType):
-        ''' This function intersects a evaluation feature with a test feature set and returns a feature collection '''
-        outputJSON = {}
-        outputJSON["type"] = "FeatureCollection"
-        featureCollectionList = []
+    def checkIntersection(self, planLayer, evalLayer,layerType, engine=None):
+        ''' This function intersects a evaluation feature with a test feature set and returns the intersection or None.
+        An IntersectionEngine of the evaluation features only intersects the features near the boundary of the test features. '''
+        x = None
         success = 0
         try:
-            x = planLayer.intersection(evalLayer)
-            allJSON = export_to_JSON(x)
-            featureCollectionList.append(self.constructSingleFeatureDef(allJSON,layerType))
+            if engine is not None:
+                x = engine.intersection(planLayer)
+            else:
+                x = planLayer.intersection(evalLayer)
             success = 1
         except Exception as e: 
             
             success = 0
             self.logger.error("Error in intersection {0} layer: {1}".format(layerType, e))
 
-        outputJSON["features"]= featureCollectionList
-        return outputJSON, success
-
-    def genUnaryUnion(self, colorList ):
-        try:
-            colorUnion = unary_union([x for x in colorList if x.geom_type in ['Polygon' ,'MultiPolygon']])
-        except Exception as e:
-            self.logger.error("Union failed: %s" % e)
-            colorUnion = unary_union([x for x in colorList if x.geom_type in ['Polygon','MultiPolygon'] and x.is_valid])
-
-        return colorUnion
-
-
-
-    def remove_third_dimension(self,geom):
-        if geom.is_empty:
-            return geom
-
-        if isinstance(geom, Polygon):
-            exterior = geom.exterior
-            new_exterior = self.remove_third_dimension(exterior)
-
-            interiors = geom.interiors
-            new_interiors = []
-            for int in interiors:
-                new_interiors.append(self.remove_third_dimension(int))
-
-            return Polygon(new_exterior, new_interiors)
+        return x, success
 
-        elif isinstance(geom, LinearRing):
-            return LinearRing([xy[0:2] for xy in list(geom.coords)])
+    def genUnaryUnion(self, colorList, progress=None, coverage=False):
+        colorList = np.asarray(colorList, dtype=object)
+        # Polygon and MultiPolygon type ids
+        colorList = colorList[np.isin(shapely.get_type_id(colorList), [3, 6])]
+        if coverage:
+            # polygons that only share edges are dissolved without overlay
+            return shapely.coverage_union_all(colorList)
+        myUnionEngine = UnionEngine(progress=progress)
+        return myUnionEngine.union(colorList)
 
-        elif isinstance(geom, LineString):
-            return LineString([xy[0:2] for xy in list(geom.coords)])
 
-        elif isinstance(geom, Point):
-            return Point([xy[0:2] for xy in list(geom.coords)])
 
-        elif isinstance(geom, MultiPoint):
-            points = list(geom.geoms)
-            new_points = []
-            for point in points:
-                new_points.append(self.remove_third_dimension(point))
-
-            return MultiPoint(new_points)
-
-        elif isinstance(geom, MultiLineString):
-            lines = list(geom.geoms)
-            new_lines = []
-            for line in lines:
-                new_lines.append(self.remove_third_dimension(line))
-
-            return MultiLineString(new_lines)
-
-        elif isinstance(geom, MultiPolygon):
-            pols = list(geom.geoms)
-
-            new_pols = []
-            for pol in pols:
-                new_pols.append(self.remove_third_dimension(pol))
-
-            return MultiPolygon(new_pols)
-
-        elif isinstance(geom, GeometryCollection):
-            geoms = list(geom.geoms)
+class FeatureIndex():
+    '''
+    An R-tree over the bounding boxes of the polygons of a color union, bulk
+    loaded once. The polygons do not overlap, so a test geometry only has to
+    visit the polygons whose boxes overlap it. The index is kept in memory.
+    '''
+    def __init__(self, geoms):
+        self.geoms = np.asarray(geoms, dtype=object)
+        stream = ((i, tuple(b), None) for i, b in enumerate(shapely.bounds(self.geoms).tolist()))
+        self.index = rtreeindex.Index(stream)
 
-            new_geoms = []
-            for geom in geoms:
-                new_geoms.append(self.remove_third_dimension(geom))
+    def candidates(self, geom):
+        ''' Indexes of the features whose bounding boxes overlap a part of geom '''
+        ids = []
+        for part in shapely.get_parts(geom):
+            ids.extend(self.index.intersection(part.bounds))
+        return np.unique(np.array(ids, dtype=np.intp))
 
-            return GeometryCollection(new_geoms)
+    def close(self):
+        # frees the index once the intersections are done
+        self.index.close()
 
-        else:
-            raise RuntimeError("Currently this type of geometry is not supported: {}".format(type(geom)))
 
-    def genFeature(self, geom, errorCounter):
+class IntersectionEngine():
+    '''
+    Intersects many test geometries with the same color union. Polygons of
+    the union with more than maxvertices vertices are cut in half along the
+    longer side of their bounds until every piece is small enough, so that
+    the cost of a test geometry depends on the polygons near it even when the
+    union is one large contiguous polygon. The pieces are prepared once and
+    the FeatureIndex finds the pieces whose boxes overlap a test geometry.
+    Prepared predicates then sort the candidates: pieces that do not
+    intersect are skipped, a piece that properly contains the test geometry
+    returns the test geometry and pieces within the test geometry are kept
+    whole. Only the pieces that cross the boundary of the test geometry are
+    intersected, the pieces of a cut polygon are joined again afterwards.
+    '''
+    def __init__(self, union, maxvertices=config.performance['indexvertices']):
+        self.union = union
+        self.geoms, self.source = self.split(shapely.get_parts(union), maxvertices)
+        self.featureIndex = FeatureIndex(self.geoms)
+        shapely.prepare(self.geoms)
+        # candidate pieces by the way they were resolved, containing counts the test geometries that fell inside a single piece, overlay the results redone on the whole union
+        self.stats = {'disjoint': 0, 'containing': 0, 'contained': 0, 'exact': 0, 'overlay': 0}
+
+    @staticmethod
+    def split(parts, maxvertices, maxdepth=24):
+        ''' The polygons cut into pieces of at most maxvertices vertices and the index of the polygon every piece was cut from '''
+        large = shapely.get_num_coordinates(parts) > maxvertices if maxvertices else np.zeros(len(parts), dtype=bool)
+        pieces, source = [parts[~large]], [np.flatnonzero(~large)]
+        large, largesource = parts[large], np.flatnonzero(large)
+        for depth in range(maxdepth):
+            if not len(large):
+                break
+            bounds = shapely.bounds(large)
+            wide = (bounds[:, 2] - bounds[:, 0]) >= (bounds[:, 3] - bounds[:, 1])
+            # both halves are cut along the same line
+            midx = np.where(wide, (bounds[:, 0] + bounds[:, 2]) / 2, bounds[:, 2])
+            midy = np.where(wide, bounds[:, 3], (bounds[:, 1] + bounds[:, 3]) / 2)
+            first = shapely.box(bounds[:, 0], bounds[:, 1], midx, midy)
+            second = shapely.box(np.where(wide, midx, bounds[:, 0]), np.where(wide, bounds[:, 1], midy), bounds[:, 2], bounds[:, 3])
+            halves, index = shapely.get_parts(shapely.intersection(np.concatenate([large, large]), np.concatenate([first, second])), return_index=True)
+            polygons = shapely.get_type_id(halves) == 3
+            halves, halfsource = halves[polygons], np.concatenate([largesource, largesource])[index[polygons]]
+            toolarge = shapely.get_num_coordinates(halves) > maxvertices
+            pieces.append(halves[~toolarge])
+            source.append(halfsource[~toolarge])
+            large, largesource = halves[toolarge], halfsource[toolarge]
+        # pieces that are still too large after maxdepth cuts are indexed as they are
+        return np.concatenate(pieces + [large]), np.concatenate(source + [largesource])
+
+    def intersection(self, geom):
+        ids = self.featureIndex.candidates(geom)
+        candidates = self.geoms[ids]
+        intersects = shapely.intersects(candidates, geom)
+        self.stats['disjoint'] += int((~intersects).sum())
+        candidates, ids = candidates[intersects], ids[intersects]
+        if not len(candidates):
+            return shapely.multipolygons(candidates)
+        # the pieces do not overlap, a piece that contains the test geometry is the whole intersection
+        containing = shapely.contains_properly(candidates, geom)
+        if containing.any():
+            self.stats['containing'] += 1
+            return shapely.multipolygons(shapely.get_parts(geom))
+        # only the union pieces are prepared, an engine is used by one thread so they are never shared
+        contained = shapely.within(candidates, geom)
+        self.stats['contained'] += int(contained.sum())
+        self.stats['exact'] += int((~contained).sum())
+        clipped = candidates.copy()
+        clipped[~contained] = shapely.intersection(candidates[~contained], geom)
+        source = self.source[ids]
+        pieces = []
+        for i in np.unique(source):
+            # touching edges and points are dropped
+            parts = shapely.get_parts(shapely.get_parts(clipped[source == i]))
+            parts = parts[shapely.get_type_id(parts) == 3]
+            if len(parts) > 1:
+                parts = shapely.get_parts(self.join(parts))
+            pieces.append(parts)
+        result = shapely.multipolygons(np.concatenate(pieces))
+        if len(candidates) > 1 and not result.is_valid:
+            # polygons of the union that touch in a point can be noded apart when they are intersected one by one, a join can fail in the same way
+            self.stats['overlay'] += 1
+            pieces = shapely.get_parts(shapely.intersection(self.union, geom))
+            result = shapely.multipolygons(pieces[shapely.get_type_id(pieces) == 3])
+        return result
+
+    @staticmethod
+    def join(pieces):
+        ''' The intersected pieces of one cut polygon joined along the cutting lines '''
         try:
-            curShape = asShape(geom)
-            
-            if curShape.has_z:
-                curShape = self.remove_third_dimension(curShape)
-                
+            return shapely.coverage_union_all(pieces)
+        except shapely.errors.GEOSException:
+            # the intersections noded a cutting line differently on its two sides
+            return shapely.union_all(pieces)
 
-        except Exception as e:
-            self.logger.error("Error in converting to Shape %s" % geom)
-            errorCounter+=1
-            curShape = None
-            
-        return curShape, errorCounter
+    def close(self):
+        self.featureIndex.close()
 
 
+class WorkloadSimulator():
+    '''
+    Simulates the diagrams that are intersected with an evaluation on the
+    Geodesign Hub server. The diagrams are star shaped polygons placed at
+    random within the bounds of the evaluation, their radius and number of
+    vertices are drawn from log-normal distributions. The generator is seeded
+    so every run draws the same diagrams. Every diagram is intersected with
+    the union of a color and the area of the intersection is calculated, the
+    latencies of the diagrams are summarized as percentiles.
+    '''
+    # sigma of the log-normal distribution of the diagram radius
+    RADIUSSIGMA = 0.8
+
+    def __init__(self, bounds, diagrams=None, vertices=None, size=None, seed=None):
+        self.bounds = bounds
+        self.numdiagrams = diagrams if diagrams is not None else config.performance['diagrams']
+        self.vertices = vertices if vertices is not None else config.performance['diagramvertices']
+        self.size = size if size is not None else config.performance['diagramsize']
+        self.seed = seed if seed is not None else config.performance['seed']
+        self.logger = logging.getLogger("evals logger")
+        self.diagrams = self.generate()
+
+    def generate(self):
+        rng = np.random.default_rng(self.seed)
+        minx, miny, maxx, maxy = self.bounds
+        n = self.numdiagrams
+        centers = rng.random((n, 2)) * [maxx - minx, maxy - miny] + [minx, miny]
+        # the radius is a share of the shorter side of the bounds, most diagrams are small and a few cover a district
+        radii = rng.lognormal(np.log(self.size * min(maxx - minx, maxy - miny)), self.RADIUSSIGMA, n)
+        numvertices = np.clip(np.round(rng.lognormal(np.log(self.vertices), 0.6, n)), 4, 500).astype(int)
+        ringindex = np.repeat(np.arange(n), numvertices)
+        # evenly spaced angles jittered by less than half a step keep every step under half a turn, the ring never crosses itself
+        step = np.arange(len(ringindex)) - np.repeat(np.cumsum(numvertices) - numvertices, numvertices)
+        angles = (step + (rng.random(len(ringindex)) - 0.5) * 0.8) * 2 * np.pi / numvertices[ringindex] + rng.random(n)[ringindex] * 2 * np.pi
+        vertexradii = radii[ringindex] * (0.6 + 0.8 * rng.random(len(ringindex)))
+        coords = centers[ringindex] + np.column_stack([np.cos(angles), np.sin(angles)]) * vertexradii[:, None]
+        return shapely.polygons(shapely.linearrings(coords, indices=ringindex))
+
+    @classmethod
+    def diagram_share(cls, bounds, percentile=95, size=None):
+        ''' The share of the bounds covered by a diagram with the radius at the given percentile '''
+        size = size if size is not None else config.performance['diagramsize']
+        minx, miny, maxx, maxy = bounds
+        if not (maxx > minx and maxy > miny):
+            return 1.0
+        radius = size * min(maxx - minx, maxy - miny) * math.exp(cls.RADIUSSIGMA * statistics.NormalDist().inv_cdf(percentile / 100.0))
+        return min(1.0, math.pi * radius ** 2 / ((maxx - minx) * (maxy - miny)))
+
+    def run(self, geomops, union, layerType, engine=None):
+        ''' Intersects every diagram with a color union, returns the intersections, their areas, the latency of every diagram and whether all of them succeeded '''
+        intersections, areas, latencies = [], [], []
+        success = 1
+        for diagram in self.diagrams:
+            start = time.perf_counter()
+            x, diagramsuccess = geomops.checkIntersection(diagram, union, layerType, engine=engine)
+            # the server reports the area of the diagram that falls on the color
+            area = x.area if diagramsuccess else None
+            latencies.append(time.perf_counter() - start)
+            success = success and diagramsuccess
+            intersections.append(x)
+            areas.append(area)
+        return intersections, areas, np.array(latencies), success
+
+    @staticmethod
+    def summarize(latencies):
+        ''' Percentiles of the latencies in seconds and the diagrams intersected per second '''
+        if not len(latencies):
+            return {'diagrams': 0}
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        total = latencies.sum()
+        return {'diagrams': len(latencies), 'p50': round(p50, 6), 'p95': round(p95, 6), 'p99': round(p99, 6),
+                'max': round(latencies.max(), 6), 'seconds': round(total, 4), 'diagramspersecond': round(len(latencies) / total, 1) if total else None}
+
 
 class ShapesFactory():
     '''
@@ -181,73 +391,9 @@ class ShapesFactory():
         self.logger = logging.getLogger("evals logger")
 
 
-    def remove_third_dimension(self, geom):
-        if geom.is_empty:
-            return geom
-
-        if isinstance(geom, Polygon):
-            exterior = geom.exterior
-            new_exterior = self.remove_third_dimension(exterior)
-
-            interiors = geom.interiors
-            new_interiors = []
-            for int in interiors:
-                new_interiors.append(self.remove_third_dimension(int))
-
-            return Polygon(new_exterior, new_interiors)
-
-        elif isinstance(geom, LinearRing):
-            return LinearRing([xy[0:2] for xy in list(geom.coords)])
-
-        elif isinstance(geom, LineString):
-            return LineString([xy[0:2] for xy in list(geom.coords)])
-
-        elif isinstance(geom, Point):
-            return Point([xy[0:2] for xy in list(geom.coords)])
-
-        elif isinstance(geom, MultiPoint):
-            points = list(geom.geoms)
-            new_points = []
-            for point in points:
-                new_points.append(self.remove_third_dimension(point))
-
-            return MultiPoint(new_points)
-
-        elif isinstance(geom, MultiLineString):
-            lines = list(geom.geoms)
-            new_lines = []
-            for line in lines:
-                new_lines.append(self.remove_third_dimension(line))
-
-            return MultiLineString(new_lines)
-
-        elif isinstance(geom, MultiPolygon):
-            pols = list(geom.geoms)
-
-            new_pols = []
-            for pol in pols:
-                new_pols.append(self.remove_third_dimension(pol))
-
-            return MultiPolygon(new_pols)
-
-        elif isinstance(geom, GeometryCollection):
-            geoms = list(geom.geoms)
-
-            new_geoms = []
-            for geom in geoms:
-                new_geoms.append(self.remove_third_dimension(geom))
-
-            return GeometryCollection(new_geoms)
-
-        else:
-            raise RuntimeError("Currently this type of geometry is not supported: {}".format(type(geom)))
-
     def genFeature(self, geom):
         try:
-            curShape = asShape(geom)
-            if curShape.has_z:
-                curShape = self.remove_third_dimension(curShape)
-                
+            curShape = shape(geom)
 
         except Exception as e:
             curShape = None
@@ -255,6 +401,14 @@ class ShapesFactory():
             self.logger.error("Error in converting to Shape %s" % geom)
 
         return curShape
+
+    def genFeatures(self, geoms):
+        ''' Convert a batch of geometries to an array of 2D Shapely geometries, the Z
+        coordinates are dropped for the whole batch in one pass. Geometries that
+        cannot be converted are None. '''
+        shapes = np.empty(len(geoms), dtype=object)
+        shapes[:] = [self.genFeature(geom) for geom in geoms]
+        return shapely.force_2d(shapes)
         
     def multiPolytoFeature(self, mp):
         feats =[]
@@ -267,7 +421,7 @@ class ShapesFactory():
         try:
             # Construct a unary_union assume that there are no errors in
             # geometry.
-            allDsgnPlygons = unary_union(allAreas)
+            allDsgnPlygons = UnionEngine().union(allAreas, validate=False)
         except Exception as e1:
             # If there are errors while consutrcuting the union, examine the
             # geometries further to seperate
@@ -290,6 +444,82 @@ class ShapesFactory():
 
 
 
+class UnionEngine():
+    '''
+    Unions large layers tile by tile so that no single GEOS call has to hold
+    the whole layer. The features are assigned to the cells of a grid over the
+    layer bounds by the center of their bounding box, every tile is unioned in
+    parallel and the tile unions are then merged in groups of fanout
+    neighbouring tiles, level by level, until one geometry is left. Layers with
+    fewer than tilesize features are unioned in one call.
+    '''
+    def __init__(self, tilesize=config.union['tilesize'], fanout=config.union['fanout'], workers=config.union['workers'], progress=None):
+        self.logger = logging.getLogger("evals logger")
+        self.tilesize = tilesize
+        self.fanout = fanout
+        self.workers = workers
+        self.progress = progress
+        self.tilestats = []
+
+    def report(self, msg):
+        self.logger.debug(msg)
+        if self.progress:
+            self.progress(msg)
+
+    def peak_memory(self):
+        return peak_memory()
+
+    def union_all(self, geoms, validate=True):
+        try:
+            return shapely.union_all(geoms)
+        except Exception as e:
+            if not validate:
+                raise
+            self.logger.error("Union failed: %s" % e)
+            return shapely.union_all(geoms[shapely.is_valid(geoms)])
+
+    def partition(self, geoms):
+        numtiles = int(math.ceil(len(geoms) / float(self.tilesize)))
+        columns = int(math.ceil(math.sqrt(numtiles)))
+        rows = int(math.ceil(numtiles / float(columns)))
+        bounds = shapely.bounds(geoms)
+        cx = (bounds[:, 0] + bounds[:, 2]) / 2
+        cy = (bounds[:, 1] + bounds[:, 3]) / 2
+        width = max(cx.max() - cx.min(), 1e-12)
+        height = max(cy.max() - cy.min(), 1e-12)
+        col = np.minimum(((cx - cx.min()) / width * columns).astype(int), columns - 1)
+        row = np.minimum(((cy - cy.min()) / height * rows).astype(int), rows - 1)
+        # snake through the rows so that consecutive tiles are neighbours
+        col = np.where(row % 2 == 1, columns - 1 - col, col)
+        cell = row * columns + col
+        order = np.argsort(cell, kind='stable')
+        cells, starts = np.unique(cell[order], return_index=True)
+        return np.split(geoms[order], starts[1:])
+
+    def union_tile(self, tileid, tile):
+        start = time.time()
+        u = self.union_all(tile)
+        stats = {'tile': tileid, 'features': len(tile), 'seconds': round(time.time() - start, 4), 'peakmemory': self.peak_memory()}
+        self.tilestats.append(stats)
+        self.report("Tile %(tile)s: unioned %(features)s features in %(seconds)s seconds, peak memory %(peakmemory)s MB" % stats)
+        return u
+
+    def union(self, geoms, validate=True):
+        geoms = np.asarray(geoms, dtype=object)
+        if len(geoms) <= self.tilesize:
+            return self.union_all(geoms, validate=validate)
+        tiles = self.partition(geoms)
+        self.report("Unioning %s features in %s tiles" % (len(geoms), len(tiles)))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            parts = list(executor.map(self.union_tile, range(len(tiles)), tiles))
+            # merge groups of neighbouring tile unions until one is left
+            while len(parts) > 1:
+                groups = [np.array(parts[i:i + self.fanout], dtype=object) for i in range(0, len(parts), self.fanout)]
+                parts = list(executor.map(lambda group: self.union_all(group, validate=validate), groups))
+                self.report("Merged tiles into %s parts, peak memory %s MB" % (len(parts), self.peak_memory()))
+        return parts[0]
+
+
 class GeoJSONHelper():
     def genRandom(self, featureType, numberVertices=3,
                         boundingBox=[-180.0, -90.0, 180.0, 90.0]):
@@ -2,17 +2,20 @@ from flask import Flask, url_for
 from functools import wraps
 from flask import request, Response
 import json, geojson, requests
+import zlib
 import random,os,sys
 import config
 from flask import render_template
 from werkzeug.utils import secure_filename
-import EvaluationConverter
+import JobQueue
+from ConversionOptions import ConversionOptions
 
 app = Flask(__name__)
 
-app.config['UPLOAD_FOLDER'] = 'input'
 ALLOWED_EXTENSIONS = set(['gpkg'])
 
+jobqueue = JobQueue.JobQueue()
+
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024
 
 def allowed_file(filename):
@@ -63,22 +66,92 @@ def upload_file():
         if not allowed_file(file.filename):
             op['msg']="Incorrect file Extension"
             op['opstatus'] = 0
-        if not os.path.exists(app.config['UPLOAD_FOLDER']):
-            os.mkdir(app.config['UPLOAD_FOLDER'])
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            try:
+                options = ConversionOptions.from_dict(request.form.to_dict())
+            except ValueError as e:
+                op['msg'] = str(e)
+                op['opstatus'] = 0
+                return Response(json.dumps(op), status=400, mimetype='application/json')
+            # the conversion runs on the job queue, the client polls the job
+            job = jobqueue.submit(filename, file.read(), options)
+            if job is None:
+                op['msg'] = "Too many conversions are waiting, please try again later."
+                op['opstatus'] = 0
+                return Response(json.dumps(op), status=503, mimetype='application/json')
             op['msg']="File Uploaded successfully"
-            
-            myEvalConverter = EvaluationConverter.ConvertEvaluation()
-            gj, status = myEvalConverter.convert()
-            op['gj'] = gj
-            op['status'] = status
+            op['jobid'] = job.jobid
+            op['state'] = job.state
             op['opstatus'] = 1
-            myEvalConverter.cleanDirectories()
 
     return Response(json.dumps(op), status=200, mimetype='application/json')
 
+def negotiate_encoding(accept_encoding):
+    ''' gzip or deflate if the client accepts them, None otherwise '''
+    accepted = {}
+    for part in accept_encoding.split(','):
+        params = part.strip().split(';')
+        quality = 1.0
+        for param in params[1:]:
+            if param.strip().startswith('q='):
+                try:
+                    quality = float(param.strip()[2:])
+                except ValueError:
+                    quality = 0.0
+        accepted[params[0].strip().lower()] = quality
+    for encoding in ['gzip', 'deflate']:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+def stream_result(op, gj, chunksize=64 * 1024):
+    ''' Writes the job status first and then the GeoJSON text of every layer in chunks '''
+    yield json.dumps(op)[:-1]
+    yield ', "gj": {'
+    for i, (fname, layers) in enumerate(gj.items()):
+        yield '%s%s: {' % (', ' if i else '', json.dumps(fname))
+        for j, (layer, layergj) in enumerate(layers.items()):
+            yield '%s%s: ' % (', ' if j else '', json.dumps(layer))
+            for start in range(0, len(layergj), chunksize):
+                yield layergj[start:start + chunksize]
+        yield '}'
+    yield '}}'
+
+def compress_stream(chunks, encoding):
+    # gzip and zlib wrapped deflate streams
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31 if encoding == 'gzip' else 15)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.route('/jobs/<jobid>', methods = ['GET'])
+def job_result(jobid):
+    job = jobqueue.get(jobid)
+    if not job:
+        return Response(json.dumps({'msg':"Job not found", 'opstatus':0}), status=404, mimetype='application/json')
+    op = job.get_status()
+    op['opstatus'] = 0 if job.state == 'failed' else 1
+    # the status is sent first, the converted features are streamed after it
+    chunks = stream_result(op, job.gj if job.state == 'finished' else {})
+    headers = {'Vary': 'Accept-Encoding'}
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding', ''))
+    if encoding:
+        chunks = compress_stream(chunks, encoding)
+        headers['Content-Encoding'] = encoding
+    return Response(chunks, status=200, mimetype='application/json', headers=headers)
+
+@app.route('/jobs/<jobid>/status', methods = ['GET'])
+def job_status(jobid):
+    job = jobqueue.get(jobid)
+    if not job:
+        return Response(json.dumps({'msg':"Job not found", 'opstatus':0}), status=404, mimetype='application/json')
+    op = job.get_status()
+    op['opstatus'] = 0 if job.state == 'failed' else 1
+    return Response(json.dumps(op), status=200, mimetype='application/json')
+
 if __name__ == '__main__':
     app.debug = False
     port = int(os.environ.get("PORT", 5001))
@@ -7,8 +7,79 @@ working = {
 	"directory":"working"
 }
 
-simplificationlevel = 'default' # other options are highest, high, medium and low or none
+reprojection = {
+	"batchsize": 5000 # features transformed per call to the cached Transformer
+}
+
+simplificationlevel = 'default' # other options are highest, high, medium and low or none, adaptive searches the tolerance of every layer within the adaptivesimplification budget
+
+adaptivesimplification = {
+	"vertices": None, # output vertices
+	"bytes": None, # GeoJSON output size
+	"p95test": True, # keeps every layer small enough that a diagram at the 95th percentile of the performance test intersects it within p95seconds in performance, converted to vertices with verticespersecond
+	"verticespersecond": 250000, # union vertices under a diagram intersected per second in the performance test
+	"samplesize": 500, # polygons of every layer simplified to estimate the vertex count of a tolerance
+	"iterations": 12 # steps of the tolerance search
+}
+
+simplificationmode = 'independent' # every polygon is simplified on its own, 'topology' simplifies the boundaries shared by neighbouring polygons once so they stay together, where polygons overlap the first one keeps the overlap
+
+simplification = {
+	"workers": None, # processes that simplify chunks of features, None uses the number of processors, 1 simplifies in the converting thread
+	"chunksize": 2000 # features sent to a worker process at a time as WKB
+}
+
+areathreshold = 0.005 # features smaller than this share of the largest feature are removed before simplification
+
+precision = 6 # decimals of the coordinates in the GeoJSON output
+
+quantization = {
+	"gridsize": 1e-6 # degrees, coordinates are snapped to this grid before they are written, 0 turns it off
+}
 
 geojsonoutput ={
 	"directory": "output"
-}
\ No newline at end of file
+}
+
+workspace = {
+	"tmpfs": "/dev/shm", # in-memory filesystem for the input and working files of small uploads, set to None to always use the working directory
+	"tmpfsmaxsize": 20 * 1024 * 1024 # bytes
+}
+
+performance = {
+	"workers": None, # threads for the per-color unions and intersections, None uses the number of processors
+	"diagrams": 200, # diagrams intersected with every color union in the performance test
+	"diagramvertices": 12, # median number of vertices of a diagram
+	"diagramsize": 0.04, # median radius of a diagram as a share of the shorter side of the evaluation bounds
+	"seed": 1, # seed of the diagram generator, the same evaluation is always tested with the same diagrams
+	"p95seconds": 0.5, # the test fails when 5% of the diagrams take longer than this to intersect with a color
+	"indexvertices": 10000 # union polygons with more vertices are cut into smaller pieces before they are indexed, 0 keeps them whole
+}
+
+union = {
+	"tilesize": 20000, # layers with more features are unioned tile by tile
+	"fanout": 16, # tile unions merged together at each level
+	"workers": None # threads for the tile unions, None uses the number of processors
+}
+
+cache = {
+	"directory": "cache",
+	"maxsize": 500 * 1024 * 1024, # bytes, least recently used results are evicted
+	"geometrymaxsize": 500 * 1024 * 1024 # bytes of WKB in the union geometry cache
+}
+
+jobs = {
+	"workers": 4, # conversion threads, every job has its own workspace
+	"maxjobs": 100, # finished jobs kept for polling
+	"maxage": 3600, # seconds a finished job is kept for polling
+	"maxbytes": 200 * 1024 * 1024, # GeoJSON text of the finished jobs kept in memory, the newest finished job is always kept
+	"maxqueued": 20 # uploads waiting for a worker, further uploads are refused until the queue drains
+}
+
+profiling = {
+	"tracemalloc": False, # trace the Python allocations of every stage, slows the conversion down
+	"cprofile": False, # write a cProfile dump of the conversion thread of every job to the directory
+	"directory": "profiles"
+}
+
+debug = False # write the intermediate Geopackages of every stage to the working directory
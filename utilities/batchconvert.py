@@ -0,0 +1,109 @@
+'''
+Converts a directory or glob of Geopackages in parallel, every file in its own
+workspace on its own process. Writes a GeoJSON per file, or per layer for files
+with several layers, and a summary.json with the status and timings of every
+conversion to the output directory.
+
+    python utilities/batchconvert.py evaluations/ -o converted
+    python utilities/batchconvert.py "evaluations/*.gpkg" -j 4 --simplificationlevel medium --no-performancetest
+'''
+import os, sys
+import argparse
+import glob
+import json
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import config
+import EvaluationConverter
+import EvaluationFileOps
+from ConversionOptions import ConversionOptions
+
+
+def find_geopackages(paths):
+    gpkgfiles = []
+    for path in paths:
+        if os.path.isdir(path):
+            gpkgfiles.extend(sorted(glob.glob(os.path.join(path, '*.gpkg'))))
+        else:
+            gpkgfiles.extend(sorted(f for f in glob.glob(path) if f.endswith('.gpkg')))
+    return gpkgfiles
+
+
+def convert_file(filepath, outname, outdir, options):
+    # every file is converted on its own core, the simplification stays in this process
+    config.simplification['workers'] = 1
+    start, cpustart = time.time(), time.process_time()
+    workspace = EvaluationFileOps.Workspace(size=os.path.getsize(filepath))
+    converter = EvaluationConverter.ConvertEvaluation(workspace=workspace, options=ConversionOptions(**options))
+    result = {'file': filepath}
+    try:
+        shutil.copy(filepath, os.path.join(converter.SOURCE_FILE_SHARE, os.path.basename(filepath)))
+        gj, status = converter.convert()
+        result['status'] = json.loads(status)
+        layers = gj.get(os.path.basename(filepath), {})
+        result['output'] = {}
+        for layer, layergj in layers.items():
+            result['output'][layer] = os.path.join(outdir, outname + ('-' + layer if len(layers) > 1 else '') + '.geojson')
+            with open(result['output'][layer], 'w') as outFile:
+                outFile.write(layergj)
+        result['converted'] = bool(layers) and 0 not in [stage['status'] for stage in result['status'].values()]
+    except Exception as e:
+        result['converted'] = False
+        result['error'] = str(e)
+    finally:
+        converter.cleanDirectories()
+    result['seconds'] = round(time.time() - start, 4)
+    result['cpuseconds'] = round(time.process_time() - cpustart, 4)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert Geopackages to Geodesignhub evaluation GeoJSON in parallel")
+    parser.add_argument('paths', nargs='+', help="directories or globs of Geopackages")
+    parser.add_argument('-o', '--output', default='output', help="directory for the GeoJSON files and summary.json")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help="files converted at the same time")
+    parser.add_argument('--simplificationlevel', choices=ConversionOptions.SIMPLIFICATIONLEVELS)
+    parser.add_argument('--tolerance', type=float)
+    parser.add_argument('--simplificationmode', choices=ConversionOptions.SIMPLIFICATIONMODES)
+    parser.add_argument('--areathreshold', type=float)
+    parser.add_argument('--precision', type=int)
+    parser.add_argument('--no-performancetest', dest='performancetest', action='store_false', help="skip the stage 7 performance test")
+    args = parser.parse_args()
+
+    options = {k: getattr(args, k) for k in ['simplificationlevel', 'tolerance', 'simplificationmode', 'areathreshold', 'precision', 'performancetest']}
+    try:
+        ConversionOptions(**options)
+    except ValueError as e:
+        parser.error(str(e))
+
+    gpkgfiles = find_geopackages(args.paths)
+    if not gpkgfiles:
+        parser.error("No Geopackages found in %s" % ' '.join(args.paths))
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    # files with the same name in different directories get a numbered output name
+    outnames, seen = [], {}
+    for filepath in gpkgfiles:
+        name = os.path.splitext(os.path.basename(filepath))[0]
+        seen[name] = seen.get(name, 0) + 1
+        outnames.append(name + ('-%s' % seen[name] if seen[name] > 1 else ''))
+
+    start = time.time()
+    results = []
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(convert_file, filepath, outname, args.output, options) for filepath, outname in zip(gpkgfiles, outnames)]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print("%s %s in %.2f seconds" % ('converted' if result['converted'] else 'failed', result['file'], result['seconds']))
+
+    results.sort(key=lambda r: gpkgfiles.index(r['file']))
+    summary = {'files': len(results), 'converted': sum(1 for r in results if r['converted']), 'seconds': round(time.time() - start, 4), 'options': options, 'results': results}
+    with open(os.path.join(args.output, 'summary.json'), 'w') as summaryFile:
+        json.dump(summary, summaryFile, indent=2)
+    print("%s of %s files converted, summary written to %s" % (summary['converted'], summary['files'], os.path.join(args.output, 'summary.json')))
+    sys.exit(0 if summary['converted'] == summary['files'] else 1)
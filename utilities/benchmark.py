@@ -0,0 +1,308 @@
+'''
+Generates synthetic evaluation Geopackages of a controlled size and converts
+them with ConvertEvaluation, recording the wall and CPU time, throughput and
+peak memory of every stage to a JSON results file. Every conversion runs in a
+fresh process so the memory peaks of the cases do not mix, the stages are the
+median of the repeats. With a baseline the results are compared against it
+and the exit code is 1 when a stage got slower or used more memory than the
+tolerance allows. Every generated Geopackage is also written with the
+GeoJSONWriter and compared with json.dumps(mapping()), the exit code is 1
+when a geometry differs.
+
+    python utilities/benchmark.py -o benchmark.json
+    python utilities/benchmark.py --cases small dense -r 5 --baseline baseline.json
+    python utilities/benchmark.py --features 20000 --vertices 200 --multipolygonshare 0.5 --areatypes red=3,yellow=1,green=1
+    python utilities/benchmark.py --baseline baseline.json --update-baseline
+'''
+import os, sys
+import argparse
+import io
+import json
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import fiona
+import shapely
+from pyproj import CRS
+from shapely.geometry import shape, mapping
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import config
+import EvaluationConverter
+import EvaluationFileOps
+import ShapelyHelper
+from ConversionOptions import ConversionOptions
+
+AREATYPES = ['red', 'yellow', 'green', 'green2', 'green3']
+
+# the parameters of a case default to these, features are multiplied by --scale
+DEFAULTCASE = {'features': 1000, 'vertices': 40, 'vertexsigma': 0.5, 'multipolygonshare': 0.3, 'holeshare': 0.1, 'threedshare': 0.0,
+               'epsg': 32633, 'areatypes': {'red': 1, 'yellow': 1, 'green': 1, 'green2': 1, 'green3': 1}, 'seed': 1}
+
+SUITE = {
+    'small': {'features': 500},
+    'large': {'features': 8000},
+    'dense': {'features': 500, 'vertices': 1000, 'vertexsigma': 0.3},
+    'multipart': {'features': 2000, 'multipolygonshare': 0.8},
+    'holes': {'features': 2000, 'holeshare': 1.0},
+    '3d': {'features': 2000, 'threedshare': 1.0},
+}
+
+# stage metrics that are compared against the baseline, larger is worse
+COMPARED = ['wallseconds', 'peakmemory']
+
+
+def generate_geopackage(filepath, features=1000, vertices=40, vertexsigma=0.5, multipolygonshare=0.3, holeshare=0.1, threedshare=0.0,
+                        epsg=32633, areatypes=None, seed=1):
+    '''
+    Writes a Geopackage of random star shaped polygons, the polygons never
+    intersect themselves, their holes stay inside them and the parts of a
+    feature never overlap so every feature is valid.
+
+    features - number of features
+    vertices, vertexsigma - the vertices of every ring are drawn from a log-normal distribution with this median and sigma
+    multipolygonshare - share of the features that have two to four parts
+    holeshare - share of the polygons with a hole
+    threedshare - share of the features with Z coordinates, the layer is 3D when there are any
+    epsg - projected CRS of the coordinates, the features are placed around the false easting and northing of a UTM zone
+    areatypes - dictionary of areatype: weight, the areatypes of the features are drawn with these weights
+    seed - seed of the random generator, the same parameters always write the same features
+    '''
+    rng = np.random.default_rng(seed)
+    areatypes = areatypes if areatypes else DEFAULTCASE['areatypes']
+    names = list(areatypes.keys())
+    weights = np.array([areatypes[name] for name in names], dtype=float)
+    featureareatypes = rng.choice(names, size=features, p=weights / weights.sum())
+    # the features are about a kilometre apart whatever their number
+    side = max(1.0, np.sqrt(features)) * 1000.0
+    centers = rng.random((features, 2)) * side + [500000.0, 5000000.0]
+    numparts = np.where(rng.random(features) < multipolygonshare, rng.integers(2, 5, size=features), 1)
+    threed = rng.random(features) < threedshare
+
+    schema = {'geometry': '3D MultiPolygon' if threed.any() else 'MultiPolygon', 'properties': {'areatype': 'str'}}
+    with fiona.open(filepath, 'w', driver='GPKG', crs_wkt=CRS.from_epsg(epsg).to_wkt(), schema=schema) as c:
+        for i in range(features):
+            polygons = []
+            for part in range(numparts[i]):
+                numvertices = max(4, int(round(rng.lognormal(np.log(vertices), vertexsigma))))
+                # the radius is between 140 and 260 metres, parts 600 metres apart never overlap
+                center = centers[i] + [600.0 * part, 0.0]
+                rings = [star_ring(rng, center, 200.0, numvertices)]
+                if rng.random() < holeshare:
+                    # the edges of a shell with few vertices pass close to the center, the hole reaches at most
+                    # 0.65 of the distance to the nearest edge so it never touches the shell
+                    inner = shapely.distance(shapely.points(center), shapely.linearrings(rings[0]))
+                    rings.append(star_ring(rng, center, inner * 0.5, max(4, numvertices // 4)))
+                if threed[i]:
+                    z = rng.random() * 100.0
+                    rings = [np.column_stack([ring, np.full(len(ring), z)]) for ring in rings]
+                polygons.append([ring.tolist() for ring in rings])
+            c.write({'geometry': {'type': 'MultiPolygon', 'coordinates': polygons}, 'properties': {'areatype': str(featureareatypes[i])}})
+    return filepath
+
+
+def star_ring(rng, center, radius, numvertices):
+    ''' A closed ring of numvertices around center, every vertex is 0.7 to 1.3 times radius away from it '''
+    # evenly spaced angles jittered by less than half a step, a step over half a turn would let the ring cross itself
+    angles = (np.arange(numvertices) + (rng.random(numvertices) - 0.5) * 0.8 + rng.random()) * 2 * np.pi / numvertices
+    radii = radius * (0.7 + 0.6 * rng.random(numvertices))
+    ring = np.column_stack([center[0] + radii * np.cos(angles), center[1] + radii * np.sin(angles)])
+    return np.vstack([ring, ring[:1]])
+
+
+def round_coordinates(coordinates, precision):
+    ''' Nested coordinate lists with every ordinate rounded to precision decimals '''
+    if isinstance(coordinates[0], (int, float)):
+        return [round(ordinate, precision) for ordinate in coordinates]
+    return [round_coordinates(part, precision) for part in coordinates]
+
+
+def check_geojsonwriter(filepath, precision=config.precision):
+    '''
+    Writes the features of a Geopackage and their single Polygons with the
+    GeoJSONWriter and compares every geometry with json.dumps(mapping()) of
+    the same geometry in 2D, the coordinates of both rounded to precision.
+    Returns the number of geometries that differ and the number checked.
+    '''
+    with fiona.open(filepath) as source:
+        features = [shape(feature['geometry']) for feature in source]
+    geoms = list(features) + list(shapely.get_parts(features))
+    sink = io.StringIO()
+    ShapelyHelper.GeoJSONWriter(sink, precision=precision).write_featurecollection(({}, geom) for geom in geoms)
+    written = [feature['geometry'] for feature in json.loads(sink.getvalue())['features']]
+    mismatches = 0
+    for geom, geometry in zip(geoms, written):
+        expected = json.loads(json.dumps(mapping(shapely.force_2d(geom))))
+        if geometry['type'] != expected['type'] or round_coordinates(geometry['coordinates'], precision) != round_coordinates(expected['coordinates'], precision):
+            mismatches += 1
+    return mismatches + abs(len(geoms) - len(written)), len(geoms)
+
+
+def run_conversion(filepath, options, tracemalloc=False):
+    ''' Converts one Geopackage in its own workspace and returns the status of every stage '''
+    # the result and geometry caches are not shared with the application or with the other runs
+    cachedirectory = tempfile.mkdtemp(prefix='benchmark-cache-')
+    config.cache['directory'] = cachedirectory
+    config.profiling['tracemalloc'] = tracemalloc
+    workspace = EvaluationFileOps.Workspace(size=os.path.getsize(filepath))
+    converter = EvaluationConverter.ConvertEvaluation(workspace=workspace, options=ConversionOptions(**options))
+    try:
+        shutil.copy(filepath, os.path.join(converter.SOURCE_FILE_SHARE, os.path.basename(filepath)))
+        start = time.time()
+        gj, status = converter.convert()
+        seconds = time.time() - start
+    finally:
+        converter.cleanDirectories()
+        shutil.rmtree(cachedirectory, ignore_errors=True)
+    return {'seconds': seconds, 'status': json.loads(status)}
+
+
+def summarize(runs):
+    ''' The median of every stage metric over the repeats of a case '''
+    stages = {}
+    for stage in runs[0]['status'].keys():
+        profiles = [run['status'][stage].get('profile') for run in runs]
+        if not all(profiles):
+            continue
+        stages[stage] = {'status': runs[0]['status'][stage]['status']}
+        for name, value in profiles[0].items():
+            if name in ['started', 'finished', 'layers'] or value is None:
+                continue
+            stages[stage][name] = round(statistics.median([profile[name] for profile in profiles]), 4)
+        # latency percentiles of the simulated diagrams of every color
+        for color, workload in runs[0]['status'][stage].get('workload', {}).items():
+            stages[stage].setdefault('workload', {})[color] = {name: round(statistics.median([run['status'][stage]['workload'][color][name] for run in runs]), 6)
+                                                               for name, value in workload.items() if value is not None}
+    return {'seconds': round(statistics.median([run['seconds'] for run in runs]), 4), 'stages': stages}
+
+
+def compare(results, baseline, tolerance, minseconds):
+    ''' Returns a line for every stage metric that is worse than the baseline by more than the tolerance '''
+    regressions = []
+    for name, case in results['cases'].items():
+        basecase = baseline['cases'].get(name)
+        if basecase is None or basecase['parameters'] != case['parameters']:
+            print("%s is not in the baseline with the same parameters, not compared" % name)
+            continue
+        for stage, profile in case['stages'].items():
+            for metric in COMPARED:
+                new, base = profile.get(metric), basecase['stages'].get(stage, {}).get(metric)
+                if not new or not base:
+                    continue
+                # short stages are noisy, they have to be slower by minseconds as well
+                if new > base * (1 + tolerance) and (metric != 'wallseconds' or new - base > minseconds):
+                    regressions.append("%s stage %s %s %.4f, baseline %.4f (%+.0f%%)" % (name, stage, metric, new, base, (new / base - 1) * 100))
+    return regressions
+
+
+def environment():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'shapely': shapely.__version__, 'geos': shapely.geos_version_string, 'numpy': np.__version__,
+            'fiona': fiona.__version__, 'pipelineversion': EvaluationConverter.PIPELINE_VERSION}
+
+
+def parse_areatypes(value):
+    areatypes = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        if name not in AREATYPES:
+            raise argparse.ArgumentTypeError("areatypes have to be %s" % ', '.join(AREATYPES))
+        try:
+            areatypes[name] = float(weight) if weight else 1.0
+        except ValueError:
+            raise argparse.ArgumentTypeError("the weight of %s has to be a number" % name)
+    return areatypes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the conversion stages on synthetic evaluation Geopackages")
+    parser.add_argument('--cases', nargs='+', choices=sorted(SUITE.keys()), help="cases of the suite to run, all of them by default")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiplies the features of every case")
+    parser.add_argument('-r', '--repeats', type=int, default=3, help="conversions of every case, the stages are the median")
+    parser.add_argument('-o', '--output', default='benchmark.json', help="JSON results file")
+    parser.add_argument('--data', help="directory to keep the generated Geopackages in")
+    parser.add_argument('--tracemalloc', action='store_true', help="trace the Python allocations of every stage")
+    parser.add_argument('--baseline', help="results file to compare against")
+    parser.add_argument('--update-baseline', action='store_true', help="write the results to the baseline instead of comparing")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="share a stage metric can grow over the baseline")
+    parser.add_argument('--minseconds', type=float, default=0.05, help="seconds a stage has to get slower by to be a regression")
+    # a custom case replaces the suite when any of its parameters is given
+    parser.add_argument('--features', type=int)
+    parser.add_argument('--vertices', type=int)
+    parser.add_argument('--vertexsigma', type=float)
+    parser.add_argument('--multipolygonshare', type=float)
+    parser.add_argument('--holeshare', type=float)
+    parser.add_argument('--threedshare', type=float)
+    parser.add_argument('--epsg', type=int)
+    parser.add_argument('--areatypes', type=parse_areatypes, help="weights of the areatypes, red=2,yellow=1,green=1")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--simplificationlevel', choices=ConversionOptions.SIMPLIFICATIONLEVELS)
+    parser.add_argument('--simplificationmode', choices=ConversionOptions.SIMPLIFICATIONMODES)
+    parser.add_argument('--no-performancetest', dest='performancetest', action='store_false', help="skip the stage 7 performance test")
+    args = parser.parse_args()
+
+    if args.update_baseline and not args.baseline:
+        parser.error("--update-baseline needs --baseline")
+    options = {k: getattr(args, k) for k in ['simplificationlevel', 'simplificationmode', 'performancetest']}
+    custom = {k: getattr(args, k) for k in DEFAULTCASE.keys() if getattr(args, k) is not None}
+    if custom:
+        cases = {'custom': dict(DEFAULTCASE, **custom)}
+    else:
+        cases = {name: dict(DEFAULTCASE, **SUITE[name]) for name in (args.cases if args.cases else SUITE.keys())}
+    for case in cases.values():
+        case['features'] = max(1, int(case['features'] * args.scale))
+        if not all(0 <= case[share] <= 1 for share in ['multipolygonshare', 'holeshare', 'threedshare']):
+            parser.error("multipolygonshare, holeshare and threedshare have to be between 0 and 1")
+
+    datadirectory = args.data if args.data else tempfile.mkdtemp(prefix='benchmark-data-')
+    if not os.path.exists(datadirectory):
+        os.makedirs(datadirectory)
+    writerfailures = []
+    results = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'environment': environment(), 'options': options, 'repeats': args.repeats, 'cases': {}}
+    try:
+        for name, case in cases.items():
+            filepath = os.path.join(datadirectory, name + '.gpkg')
+            generatestart = time.time()
+            generate_geopackage(filepath, **case)
+            print("%s: generated %s features in %.2f seconds" % (name, case['features'], time.time() - generatestart))
+            mismatches, checked = check_geojsonwriter(filepath)
+            print("    GeoJSONWriter: %s of %s geometries differ from mapping()" % (mismatches, checked))
+            if mismatches:
+                writerfailures.append(name)
+            runs = []
+            for repeat in range(args.repeats):
+                # a fresh process for every run so the peak memory is the run's own
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    runs.append(executor.submit(run_conversion, filepath, options, args.tracemalloc).result())
+            results['cases'][name] = dict(summarize(runs), parameters=case)
+            for stage, profile in results['cases'][name]['stages'].items():
+                print("    stage %s %8.4f s %12.1f vertices/s %8.1f MB" % (stage, profile['wallseconds'], profile.get('verticespersecond', 0), profile.get('peakmemory') or 0))
+    finally:
+        if not args.data:
+            shutil.rmtree(datadirectory, ignore_errors=True)
+
+    with open(args.output, 'w') as resultsFile:
+        json.dump(results, resultsFile, indent=2)
+    print("results written to %s" % args.output)
+
+    if writerfailures:
+        print("GeoJSONWriter output differs from mapping() in %s" % ', '.join(writerfailures))
+        sys.exit(1)
+
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, 'w') as baselineFile:
+            json.dump(results, baselineFile, indent=2)
+        print("baseline written to %s" % args.baseline)
+    elif args.baseline:
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+        regressions = compare(results, baseline, args.tolerance, args.minseconds)
+        for regression in regressions:
+            print("regression: %s" % regression)
+        print("%s regressions against %s" % (len(regressions), args.baseline))
+        sys.exit(1 if regressions else 0)